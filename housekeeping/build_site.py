@@ -0,0 +1,332 @@
+#!/usr/bin/env python3
+
+"""
+Builds the site locally as static HTML, instead of waiting for GitHub's Jekyll.
+
+Usage: build_site.py [-o out_dir] [-j jobs] [-f] [-r] [-p port]
+-o : output directory (default: _site)
+-j : number of worker processes (default: number of CPUs)
+-f : rebuild every page, not just the changed ones
+-r : also write README.md from the same scan
+-p : serve the site on localhost:port after building, for previewing
+
+Run from the root of the repo. The Markdown under SITE_DIRS is rendered to
+HTML with python-markdown in a pool of worker processes. Each page keeps its
+source file name (Unicode and all, no rename_for_jekyll.py needed) with .html
+instead of .md, and links between pages are rewritten to match.
+
+The tree is scanned once, and the index page, the README and the navigation
+of every page (breadcrumbs, previous/next in the same directory) all come from
+that scan. A page is only re-rendered when the hash of its source, its
+navigation or BUILD_VERSION changed; the hashes are kept in out_dir/.manifest.json.
+Other files (images) are copied when their size or mtime changed.
+"""
+
+import getopt
+import hashlib
+import html
+import json
+import os
+import re
+import shutil
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from urllib.parse import quote as url_quote
+
+SITE_DIRS = ["writings", "recipes", "bookmarks", "stream", "outline"]
+SITE_TITLE = "散彈一號公廁"
+# Bump when the page template or the rendering changes, to rebuild everything
+BUILD_VERSION = "1"
+MANIFEST = ".manifest.json"
+
+MD_LINK_RE = re.compile(r'href="([^":#?]+)\.md(#[^"]*)?"')
+
+PAGE_TEMPLATE = """<!DOCTYPE html>
+<html lang="zh-Hant-HK">
+<head>
+<meta charset="utf-8">
+<meta name="viewport" content="width=device-width, initial-scale=1">
+<title>{title} - {site_title}</title>
+<style>
+body {{ max-width: 46em; margin: 0 auto; padding: 1em; font-family: sans-serif; line-height: 1.6; color: #222; }}
+nav {{ font-size: 0.9em; color: #666; }}
+nav.pager {{ display: flex; justify-content: space-between; border-top: 1px solid #ddd; margin-top: 2em; padding-top: 1em; }}
+img {{ max-width: 100%; }}
+pre {{ overflow-x: auto; background: #f6f8fa; padding: 0.5em; }}
+blockquote {{ border-left: 3px solid #ddd; margin-left: 0; padding-left: 1em; color: #555; }}
+</style>
+</head>
+<body>
+{nav}
+<main>
+{body}
+</main>
+{pager}
+</body>
+</html>
+"""
+
+
+def scan(root="."):
+    """ Returns the relative paths of all files under root, skipping dot directories """
+    found = []
+    for dirpath, directories, files in os.walk(root):
+        directories[:] = [d for d in directories if not d.startswith(".")]
+        for fn in files:
+            found.append(os.path.relpath(os.path.join(dirpath, fn), root))
+    return found
+
+
+def insert(node, key_path, value):
+    if len(key_path) == 1:
+        if key_path[0] not in node:
+            node[key_path[0]] = []
+
+        node[key_path[0]].append(value)
+        return
+
+    if key_path[0] not in node:
+        node[key_path[0]] = {}
+
+    return insert(node[key_path[0]], key_path[1:], value)
+
+
+def page_tree(paths):
+    """ Nests the .md paths by directory, {"writings": {"2024": ["01-x.md", ...]}, ...} """
+    root_node = {}
+    for path in paths:
+        if path.endswith(".md"):
+            directory, fn = os.path.split(path)
+            insert(root_node, directory.split(os.path.sep), fn)
+    return root_node
+
+
+def capitalize_if_necessary(s):
+    if re.match(r'^[a-zA-Z]+', s):
+        return s[0].upper() + s[1:]
+    return s
+
+
+def preorder_dfs(node, f, d = []):
+    if hasattr(node, "append"):
+        for item in sorted(node, reverse=True):
+            preorder_dfs(item, f, d + [item,])
+    elif hasattr(node, "keys"):
+        for k in sorted(node.keys(), reverse=True):
+            f(k, d)
+            preorder_dfs(node[k], f, d + [k,])
+    else:
+        f(node, d + [None,])
+
+
+def transformback(s):
+    if s.endswith('.md'):
+        s = s[:-3]
+    return (s
+        .replace('_qm_', '?')
+        .replace("_ex_", "!").replace("_EX_", "！")
+        .replace('_cl_', ':').replace('_CL_', '：')
+        .replace("_lp_", "(").replace("_rp_", ")")
+        .replace("_LP_", "（").replace("_RP_", "）")
+        .replace('_cm_', ',').replace('_CM_', '，')
+
+        .replace('_', ' ') # keep this last
+        )
+
+
+def readme(tree):
+    lines = [
+        "# 散彈一號公廁 (shotgun1 public crap)",
+        "",
+        "Github Pages link [https://hnfong.github.io/public-crap/](https://hnfong.github.io/public-crap/)",
+    ]
+
+    def p(s, d):
+        if len(d) > 0 and d[-1] is None:
+            # Leaf node
+
+            # Do nothing for the readme file.
+            if s == "README.md":
+                return
+
+            url = '/'.join(dd for dd in d[:-1])
+            lines.append(f"- [{transformback(s)}]({url})")
+        else:
+            if s == "":
+                return
+
+            lines.append("")
+            lines.append(("#" * (len(d)+2) ) + " " + capitalize_if_necessary(s))
+            lines.append("")
+
+    preorder_dfs(tree, p)
+    return "\n".join(lines)
+
+
+def site_pages(tree):
+    """ Returns the pages under SITE_DIRS as (directory parts, file name), in README order """
+    pages = []
+
+    def p(s, d):
+        if len(d) > 0 and d[-1] is None and d[0] in SITE_DIRS:
+            pages.append((d[:-2], s))
+
+    preorder_dfs(tree, p)
+    return pages
+
+
+def html_path(parts, fn):
+    return "/".join(parts + [fn[:-3] + ".html"])
+
+
+def href(from_parts, to_path):
+    """ Relative, percent encoded link, so the site works from any base URL (and file://) """
+    return url_quote(os.path.relpath(to_path, "/".join(from_parts) or "."))
+
+
+def index_html(tree):
+    out = []
+
+    def p(s, d):
+        if len(d) > 0 and d[-1] is None:
+            out.append(f'<li><a href="{href([], html_path(d[:-2], s))}">{html.escape(transformback(s))}</a></li>')
+        else:
+            level = len(d) + 2
+            anchor = "/".join(d + [s])
+            out.append(f'<h{level} id="{html.escape(anchor)}">{html.escape(capitalize_if_necessary(s))}</h{level}>')
+
+    site_tree = {k: v for k, v in tree.items() if k in SITE_DIRS}
+    preorder_dfs(site_tree, p)
+    # Group the list items
+    body = re.sub(r"((?:<li>.*</li>\n?)+)", lambda m: "<ul>\n" + m.group(1) + "</ul>\n", "\n".join(out) + "\n")
+    return f"<h1>{html.escape(SITE_TITLE)}</h1>\n" + body
+
+
+def navigation(parts, fn, siblings):
+    crumbs = [f'<a href="{href(parts, "index.html")}">{html.escape(SITE_TITLE)}</a>']
+    for i in range(len(parts)):
+        crumbs.append(f'<a href="{href(parts, "index.html")}#{url_quote("/".join(parts[:i + 1]))}">{html.escape(capitalize_if_necessary(parts[i]))}</a>')
+    nav = "<nav>" + " / ".join(crumbs) + "</nav>"
+
+    i = siblings.index(fn)
+    links = []
+    for label, j in (("←", i - 1), ("→", i + 1)):
+        if 0 <= j < len(siblings):
+            title = html.escape(transformback(siblings[j]))
+            links.append(f'<a href="{href(parts, html_path(parts, siblings[j]))}">{label + " " + title if label == "←" else title + " " + label}</a>')
+        else:
+            links.append("<span></span>")
+    return nav, '<nav class="pager">' + "".join(links) + "</nav>"
+
+
+def render_page(job):
+    """ Runs in a worker process: renders one page and writes it out, returns its output path """
+    import markdown
+    source, out_path, title, nav, pager = job
+    with open(source, encoding="utf-8") as f:
+        body = markdown.markdown(f.read(), extensions=["fenced_code", "tables", "sane_lists"])
+    body = MD_LINK_RE.sub(lambda m: f'href="{m.group(1)}.html{m.group(2) or ""}"', body)
+    write_file(out_path, PAGE_TEMPLATE.format(title=html.escape(title), site_title=html.escape(SITE_TITLE), nav=nav, body=body, pager=pager))
+    return out_path
+
+
+def write_file(path, content):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        f.write(content)
+    os.replace(path + ".tmp", path)
+
+
+def copy_if_changed(source, dest):
+    try:
+        st, dst = os.stat(source), os.stat(dest)
+        if st.st_size == dst.st_size and st.st_mtime_ns == dst.st_mtime_ns:
+            return False
+    except FileNotFoundError:
+        pass
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+    shutil.copy2(source, dest)
+    return True
+
+
+def build(out_dir, jobs=None, force=False, write_readme=False):
+    paths = scan(".")
+    tree = page_tree(paths)
+    if write_readme:
+        with open("README.md", "w") as f:
+            f.write(readme(tree) + "\n")
+
+    manifest_path = os.path.join(out_dir, MANIFEST)
+    manifest = {}
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+
+    pages = site_pages(tree)
+    siblings = {}
+    for parts, fn in pages:
+        siblings.setdefault(tuple(parts), []).append(fn)
+
+    new_manifest = {}
+    todo = []
+    for parts, fn in pages:
+        source = os.path.join(*parts, fn)
+        nav, pager = navigation(parts, fn, siblings[tuple(parts)])
+        with open(source, "rb") as f:
+            digest = hashlib.sha256(b"\0".join([BUILD_VERSION.encode(), nav.encode(), pager.encode(), f.read()])).hexdigest()
+        out_path = os.path.join(out_dir, html_path(parts, fn))
+        new_manifest[out_path] = digest
+        if force or manifest.get(out_path) != digest or not os.path.exists(out_path):
+            todo.append((source, out_path, transformback(fn), nav, pager))
+
+    index = index_html(tree)
+    index_path = os.path.join(out_dir, "index.html")
+    index_digest = hashlib.sha256((BUILD_VERSION + index).encode()).hexdigest()
+    new_manifest[index_path] = index_digest
+    if force or manifest.get(index_path) != index_digest or not os.path.exists(index_path):
+        write_file(index_path, PAGE_TEMPLATE.format(title="Index", site_title=html.escape(SITE_TITLE), nav="", body=index, pager=""))
+
+    copied = 0
+    for path in paths:
+        if path.split(os.path.sep)[0] in SITE_DIRS and not path.endswith(".md"):
+            dest = os.path.join(out_dir, path)
+            new_manifest[dest] = None
+            copied += copy_if_changed(path, dest)
+
+    if todo:
+        # Not worth starting processes for a page or two
+        if len(todo) < 4:
+            list(map(render_page, todo))
+        else:
+            with ProcessPoolExecutor(max_workers=jobs) as executor:
+                list(executor.map(render_page, todo, chunksize=8))
+
+    # Remove what's left of deleted or renamed sources
+    for stale in set(manifest) - set(new_manifest):
+        if os.path.exists(stale):
+            os.remove(stale)
+
+    write_file(manifest_path, json.dumps(new_manifest, ensure_ascii=False, indent=0))
+    return len(pages), len(todo), copied
+
+
+def serve(out_dir, port):
+    import functools
+    import http.server
+    handler = functools.partial(http.server.SimpleHTTPRequestHandler, directory=out_dir)
+    print(f"Serving {out_dir} on http://localhost:{port}/")
+    http.server.ThreadingHTTPServer(("127.0.0.1", port), handler).serve_forever()
+
+
+if __name__ == "__main__":
+    opt_list, args = getopt.getopt(sys.argv[1:], "ho:j:frp:")
+    opts = dict(opt_list)
+    if "-h" in opts:
+        print(__doc__)
+        sys.exit(0)
+
+    out_dir = opts.get("-o") or "_site"
+    total, rendered, copied = build(out_dir, int(opts["-j"]) if opts.get("-j") else None, "-f" in opts, "-r" in opts)
+    print(f"{rendered} of {total} pages rendered, {copied} files copied to {out_dir}")
+    if opts.get("-p"):
+        serve(out_dir, int(opts["-p"]))
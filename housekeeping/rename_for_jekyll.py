@@ -11,6 +11,8 @@
 
 # Anyway, the workaround seems to be "escaping" question marks and other
 # dubious characters with some format that they like.
+
+# build_site.py doesn't need any of this for local builds.
 """
 
 import os
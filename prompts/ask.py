@@ -15,18 +15,23 @@ Options:
 -g: Set the no generation limit flag
 -k: Keep the temporary prompt file
 
--P args:           Pass through arguments to llama.cpp
+-P args:           Pass through arguments to llama.cpp (passing -t/-tb here overrides the tune.py profile of the model, if any)
 -C context:        Set the context for the prompt (not very useful)
 -c size:           Set context size prompt (default: 4096)
 -t temperature:    Set the temperature (default: 0.3)
 -f file:           Input prompt file (can be a glob)
+-s format:         Read prompts from stdin instead: "paths" (one path per line), "paths0" (NUL separated, e.g. find -print0) or "jsonl" (one {"user": ..., "system": ..., "file": ...} record per line)
 -o file:           Output file (can contain {n}, {m}, {f} for round, model, and file)
--p preset:         Set the preset to use (default: explain_this)
+-p preset:         Set the preset to use (default: explain_this). The "retrieve" preset answers from writings/, recipes/ and stream/ (see embed_index.py)
 -m model:          Set the model to use. This can be a string in which case the first substring match in ~/Downloads or MODELS_PATH will be used.
 -n rounds:         Set the number of rounds to run (default: 1)
 -x ignore_prefix:  Set the prefix to ignore in the prompt file (default: #!)
 -X extra_prompt:   Set the extra prompt to add to the assistant output (default: "")
 -T template:       Set the template to use (default: chatml, but we hardcode some models to use different templates)
+-A agreement:      Self-consistency mode for -n: run the samples -J at a time and stop once one final answer has this fraction of the -n votes (e.g. 0.6). Writes the majority answer to {n} = "majority"
+-J parallel:       Samples to run at the same time with -A (default: 2)
+-D draft:          Draft model for speculative decoding: auto (default, see draft.py), none, or a model name. Not used with -A
+-W model:          Prefetch this model into the page cache once ours is generating. @file means the model after ours in file (one per line, see the Makefile and residency.py)
 
 """
 
@@ -46,14 +51,22 @@ index 374ed47a..36d6cd51 100644
      bool need_to_save_session = !path_session.empty() && n_matching_session_tokens < embd_inp.size();
 """
 
+import collections
 import datetime
 import getopt
 import glob
+import itertools
+import json
+import math
 import os
+import queue
+import re
 import shutil
 import subprocess
 import sys
 import tempfile
+import threading
+import time
 
 LLAMA_CPP_PATH = os.environ.get("LLAMA_CPP_PATH") or shutil.which('llama-cli') or os.path.expanduser("~/projects/llama.gguf/llama-cli")
 MODELS_PATH = os.environ.get("MODELS_PATH") or os.path.expanduser("~/Downloads/")
@@ -63,6 +76,43 @@ DEFAULT_MODEL = "gemma-2-9b-it"
 DEFAULT_CODE_INSTRUCT_MODEL = "Qwen2.5-Coder-32B-Instruct"
 # Apparently the instruct models got their <fim> capabilities tuned away. (DeepSeek v2.5 seems fine though)
 DEFAULT_CODE_GENERATION_MODEL = "Qwen2.5-Coder-32B-Instruct"
+# Used by the retrieve preset, see embed_index.py
+DEFAULT_EMBEDDING_MODEL = os.environ.get("EMBEDDING_MODEL") or "nomic-embed-text"
+
+# How many prompts we read ahead of the one being inferred
+PREFETCH_DEPTH = 4
+
+# Written by tune.py
+TUNING_PROFILES_PATH = os.path.expanduser("~/.cache/ask/tuning.json")
+
+
+class StageTimer:
+    """
+    Lap timer for our own overhead (see bench.py). Each lap() charges the time
+    since the previous lap to the given stage. Does nothing unless ASK_TIMINGS
+    names a file to dump the totals to as JSON when we exit.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.totals = {}
+        self.counts = {}
+        self.last = time.perf_counter()
+
+    def lap(self, stage):
+        if self.path is None:
+            return
+        now = time.perf_counter()
+        self.totals[stage] = self.totals.get(stage, 0.0) + now - self.last
+        self.counts[stage] = self.counts.get(stage, 0) + 1
+        self.last = now
+
+    def dump(self):
+        if self.path is None:
+            return
+        with open(self.path, "w") as f:
+            json.dump({"totals": self.totals, "counts": self.counts}, f)
+
+TIMINGS = StageTimer(os.environ.get("ASK_TIMINGS"))
 
 # Presets
 
@@ -279,6 +329,42 @@ class ReviewPreset(Preset):
     def prompt(self):
         return f"Please review the following text. Point out (a) mistakes (if any), (b) suggestions for improvements, and (c) other comments that may be relevant. Be thoughtful and creative. Don't just make trivial comments on low hanging fruit. Be engaging. \n```{self.user_prompt}```\n"
 
+class RetrievalPreset(Preset):
+    def __init__(self, user_prompt, context):
+        super().__init__(user_prompt)
+        self.context = context
+        self._system_message = "You are a helpful, thoughtful and creative AI assistant. Answer based on the excerpts from the author's writings, and say so if they don't cover the question."
+        self._excerpts = None
+
+    name = "retrieve"
+
+    def prompt(self):
+        if self._excerpts is None:
+            # Only import numpy and friends if we actually use this preset
+            import embed_index
+            embedding_model = glob.glob(f"{MODELS_PATH}/*{DEFAULT_EMBEDDING_MODEL}*.gguf")[0]
+            self._excerpts = embed_index.retrieve(self.user_prompt, embedding_model)
+        excerpts = "\n\n".join(f"--- Excerpt from {path} ---\n{text}" for score, path, text in self._excerpts)
+        return f"Here are some excerpts from my writings that may be relevant.\n\n{excerpts}\n\n--- End of excerpts ---\n\n{self.user_prompt}\n"
+
+class TranslatePreset(Preset):
+    def __init__(self, user_prompt, context):
+        super().__init__(user_prompt)
+        self.context = context
+        self._system_message = "You are a professional translator. You translate faithfully and keep the tone and style of the original."
+
+    name = "translate"
+
+    def postprocess(self, outs):
+        return outs.replace('[end of text]', '').strip()
+
+    def has_postprocess(self):
+        return True
+
+    def prompt(self):
+        # The target language goes in -C
+        return f"Translate the following Markdown into {self.context or 'English'}. Keep the Markdown formatting and links as they are. Only output the translation, without any notes or explanations.\n\n{self.user_prompt}\n"
+
 class CodeReviewPreset(Preset):
     def __init__(self, user_prompt, context):
         super().__init__(user_prompt)
@@ -512,6 +598,29 @@ FIM_MATCH_OVERRIDE = [
 ]
 
 
+def tuning_profile(model):
+    """ Returns the tune.py profile for this model file, or None """
+    if not os.path.exists(TUNING_PROFILES_PATH):
+        return None
+    with open(TUNING_PROFILES_PATH) as f:
+        return json.load(f).get(os.path.basename(model))
+
+
+def tuning_args(profile):
+    args = ["-t", str(profile["threads"]), "-tb", str(profile["threads_batch"]), "-b", str(profile["batch"])]
+    if profile.get("numa"):
+        args += ["--numa", profile["numa"]]
+    return args
+
+
+def template_mixin_for(model, overrides=NAME_MATCH_OVERRIDE, fallback=ChatMLTemplateMixin):
+    for model_substring, tm in overrides:
+        if model_substring.lower() in model.lower():
+            return tm
+    print(f"Warning: No template found for {model}, using {fallback.__name__} as a fallback")
+    return fallback
+
+
 def read_prompt_file(prompt_file, ignore_prefix="#!", system_prefix="SYSTEM:"):
     lines = []
     system = []
@@ -528,6 +637,166 @@ def read_prompt_file(prompt_file, ignore_prefix="#!", system_prefix="SYSTEM:"):
         }
 
 
+def stdin_paths(separator):
+    """ Yields paths from stdin as they arrive, so that e.g. find -print0 can stream into us """
+    buf = b""
+    while chunk := sys.stdin.buffer.read1(65536):
+        *paths, buf = (buf + chunk).split(separator)
+        for path in paths:
+            if path:
+                yield path.decode("utf-8", errors="surrogateescape")
+    if buf.strip(b"\n"):
+        yield buf.decode("utf-8", errors="surrogateescape")
+
+
+def iter_prompts(prompt_files=(), stdin_format=None, ignore_prefix="#!"):
+    """ Yields (name, prompt) lazily, only reading each prompt file when it's needed """
+    if stdin_format == "jsonl":
+        for n, line in enumerate(sys.stdin.buffer):
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            yield (record.get("file") or f"stdin.{n}", {"user": record["user"], "system": record.get("system") or ""})
+        return
+    if stdin_format == "paths":
+        prompt_files = (path.rstrip("\r") for path in stdin_paths(b"\n"))
+    elif stdin_format == "paths0":
+        prompt_files = stdin_paths(b"\0")
+    elif stdin_format is not None:
+        raise ValueError(f"Unknown stdin format {stdin_format}")
+    for prompt_file in prompt_files:
+        yield (prompt_file, read_prompt_file(prompt_file, ignore_prefix=ignore_prefix))
+
+
+def prefetch(iterable, depth=PREFETCH_DEPTH):
+    """
+    Runs iterable in a background thread, at most depth items ahead of us. The
+    bounded queue is the backpressure: we never hold more than depth prompts
+    that inference hasn't caught up with.
+    """
+    q = queue.Queue(maxsize=depth)
+    done = object()
+
+    def producer():
+        try:
+            for item in iterable:
+                q.put((item, None))
+        except BaseException as e:
+            q.put((done, e))
+            return
+        q.put((done, None))
+
+    threading.Thread(target=producer, daemon=True).start()
+    while True:
+        item, error = q.get()
+        if error is not None:
+            raise error
+        if item is done:
+            return
+        yield item
+
+
+class ModelPlaceholder:
+    pass
+
+
+def round_command(cmd, model, template_mixin, prompt_path):
+    """
+    Fills in the model and prompt file, and adds the per model workarounds and
+    the tune.py profile. Returns (command, CPU affinity or None).
+    """
+    this_cmd = cmd.copy()
+    if 'codellama-70b' in model: # XXX: Temp hack
+        this_cmd.append("-r")
+        this_cmd.append("EOT: true")
+    if 'yi-34b' or 'starling' in model: # XXX: Temp hack
+        this_cmd.append("-r")
+        this_cmd.append("<|im_end|>")
+    if template_mixin == DeepSeekV2LiteMixin:
+        this_cmd.append("-b")
+        this_cmd.append("256") # https://github.com/ggerganov/llama.cpp/issues/7652#issuecomment-2140568771
+    if template_mixin == DeepSeekV25Mixin:  # We don't have enough RAM for 4096
+        ctx_idx = this_cmd.index("-c")
+        if ctx_idx < 0:
+            this_cmd.append("-c")
+            this_cmd.append("2048")
+        else:
+            this_cmd[ctx_idx + 1] = "2048"
+
+    this_cmd[this_cmd.index(ModelPlaceholder)] = model
+    affinity = None
+    if not any(arg in this_cmd for arg in ("-t", "--threads", "-tb", "--threads-batch")) and (profile := tuning_profile(model)):
+        # The batch size hacks above take precedence
+        profile_args = tuning_args(profile if "-b" not in this_cmd else dict(profile, batch=this_cmd[this_cmd.index("-b") + 1]))
+        this_cmd += profile_args
+        if profile.get("cpus") and hasattr(os, "sched_setaffinity"):
+            affinity = profile["cpus"]
+    this_cmd += ["-f", prompt_path]
+    return this_cmd, affinity
+
+
+def normalize_answer(text):
+    """ Reduces a response to its final answer, so that samples can be compared """
+    text = text.replace('[end of text]', '').strip()
+    if boxed := re.findall(r"\\boxed\{([^{}]*)\}", text):
+        answer = boxed[-1]
+    elif stated := re.findall(r"answer\s*(?:is|:)\s*(.+)", text, re.IGNORECASE):
+        answer = stated[-1]
+    else:
+        answer = next((line for line in reversed(text.splitlines()) if line.strip()), "")
+    return re.sub(r"[\W_]+", " ", answer.lower()).strip()
+
+
+def self_consistency(cmd, affinity, cp, rounds, threshold, parallel):
+    """
+    Runs up to rounds samples, parallel at a time. Stops launching (and kills
+    the running ones) as soon as one answer has threshold * rounds votes, or
+    when no answer can get there anymore.
+    Returns ({sample number: output}, normalized majority answer, its votes).
+    """
+    needed = math.ceil(threshold * rounds)
+    finished = queue.Queue()
+    running = {}
+    outputs = {}
+    votes = collections.Counter()
+
+    def wait_for(n, p):
+        outs = p.communicate()
+        finished.put((n, p.returncode, outs))
+
+    launched = 0
+    while launched < rounds or running:
+        while launched < rounds and len(running) < parallel:
+            p = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                 preexec_fn=(lambda: os.sched_setaffinity(0, affinity)) if affinity else None)
+            running[launched] = p
+            threading.Thread(target=wait_for, args=(launched, p), daemon=True).start()
+            launched += 1
+
+        n, returncode, outs = finished.get()
+        del running[n]
+        if returncode != 0:
+            if returncode > 0:  # Not killed by us
+                sys.stderr.write(f"Error in sample {n}: " + outs[1].decode("utf-8", errors="replace") + "\n")
+            continue
+        outs_s = outs[0].decode("utf-8", errors="replace")
+        if cp.has_postprocess():
+            outs_s = cp.postprocess(outs_s)
+        outputs[n] = outs_s
+        votes[normalize_answer(outs_s)] += 1
+
+        top_votes = votes.most_common(1)[0][1]
+        if top_votes >= needed or top_votes + (rounds - len(outputs)) < needed:
+            launched = rounds
+            for p in running.values():
+                p.terminate()
+
+    if not votes:
+        return outputs, None, 0
+    majority, top_votes = votes.most_common(1)[0]
+    return outputs, majority, top_votes
+
+
 if __name__ == "__main__":
     PRESETS = {}
     # loop through all classes in this file and add them to the presets
@@ -536,8 +805,11 @@ if __name__ == "__main__":
         if inspect.isclass(obj):
             if issubclass(obj, Preset) and obj != Preset:
                 PRESETS[obj.name] = obj
-    opt_list, args = getopt.getopt(sys.argv[1:], "qhkP:C:c:t:f:o:p:m:n:x:gX:T:v")
+    import atexit
+    atexit.register(TIMINGS.dump)
+    opt_list, args = getopt.getopt(sys.argv[1:], "qhkP:C:c:t:f:s:o:p:m:n:x:gX:T:vW:A:J:D:")
     opts = dict(opt_list)
+    TIMINGS.lap("presets")
 
     # Default to explain_this if we don't have a file. If we have a file it's better to assume the file contains a full prompt
     if opts.get("-p") is None:
@@ -553,6 +825,8 @@ if __name__ == "__main__":
             user_prompt = opts.get("-f")
         else:
             prompt_globs = sorted(glob.glob(opts.get("-f")))
+    elif opts.get("-s"):
+        pass  # Prompts are streamed from stdin
     elif args:
         user_prompt = " ".join(args)
     else:
@@ -607,14 +881,7 @@ if __name__ == "__main__":
     if preset is CodeGenerationPreset:
         # Force template to be code completion
         model = glob.glob(f"{MODELS_PATH}/*{model_name}*.gguf")[0]
-        for model_substring, tm in FIM_MATCH_OVERRIDE:
-            if model_substring.lower() in model.lower():
-                overrideTemplateMixIn = tm
-                break
-        else:
-            if overrideTemplateMixIn is None:
-                print(f"Warning: No template found for {model}, using QwenFimMixin as a fallback")
-                overrideTemplateMixIn = QwenFimMixin
+        overrideTemplateMixIn = template_mixin_for(model, FIM_MATCH_OVERRIDE, QwenFimMixin)
 
         context = args[0]
         # We need a file for code generation
@@ -638,32 +905,28 @@ if __name__ == "__main__":
         cmd_args += ["--n-predict", "-2"] # -2 means fill context
 
 
-    class ModelPlaceholder:
-        pass
-
     cmd = [LLAMA_CPP_PATH,] + cmd_args + ["-m", ModelPlaceholder]
+    TIMINGS.lap("setup")
 
     assert_count = 0
+    load_checked = set()  # Models we have logged the load time of, see residency.py
+    prefetcher = None
     for model in glob.glob(f"{MODELS_PATH}/*{model_name}*.gguf") or [model_name]:
         if '-of-000' in model and '01-of-000' not in model:
             # Only use the first shard
             continue
         assert_count += 1
         assert assert_count == 1, "We need to refactor this so that we don't iterate on the model since we actually don't need to"
+        TIMINGS.lap("model_glob")
 
         if overrideTemplateMixIn is None:
-            for model_substring, tm in NAME_MATCH_OVERRIDE:
-                if model_substring.lower() in model.lower():
-                    overrideTemplateMixIn = tm
-                    break
-            else:
-                if overrideTemplateMixIn is None:
-                    print(f"Warning: No template found for {model}, using ChatMLTemplateMixin as a fallback")
-                    overrideTemplateMixIn = ChatMLTemplateMixin
+            overrideTemplateMixIn = template_mixin_for(model)
 
         class CurrentPrompt(overrideTemplateMixIn, preset):
             pass
-        for prompt_file, prompt in zip([None,] + prompt_globs, [{"user":user_prompt},] + [read_prompt_file(prompt_file, ignore_prefix=opts.get("-x") or "#!") for prompt_file in prompt_globs]):
+        prompts = prefetch(iter_prompts(prompt_globs, stdin_format=opts.get("-s"), ignore_prefix=opts.get("-x") or "#!"))
+        for prompt_file, prompt in itertools.chain([(None, {"user": user_prompt})], prompts):
+            TIMINGS.lap("read_prompts")
             if prompt.get("user") is None:
                 continue
 
@@ -677,6 +940,7 @@ if __name__ == "__main__":
                 if sys_prompt:
                     cp.set_system_message(sys_prompt)
                 templated_prompt = cp.templated_prompt()
+                TIMINGS.lap("template")
                 if "-v" in opts:
                     print(templated_prompt)
                 temp_prompt_file.write(templated_prompt)
@@ -689,59 +953,122 @@ if __name__ == "__main__":
                     if extra[-1] != "\n":
                         temp_prompt_file.write("\n")
                 temp_prompt_file.flush()
+                TIMINGS.lap("temp_file")
+
+                if '-m' not in opts: # allow overriding the model if the user did not specify it.
+                    if cp.override_model() is not None:
+                        try:
+                            try_model = glob.glob(f"{MODELS_PATH}/*{cp.override_model()}*.gguf")[0]
+                            if not os.path.isfile(try_model):
+                                raise Exception(try_model + " exists but is not a file?!")
+                            model = try_model
+                        except Exception as e:
+                            sys.stderr.write(f"Error using {cp.override_model()} as model: {e}")
+                            sys.stderr.write("\n")
+                            sys.stderr.flush()
+
+                if opts.get("-A"):
+                    rounds = int(opts.get("-n") or 1)
+                    out_pattern = opts.get("-o")
+                    if out_pattern is not None:
+                        out_pattern = out_pattern.replace('{m}', os.path.basename(model)).replace('{f}', prompt_file or "stdin")
+                        if os.path.exists(out_pattern.replace('{n}', "majority")):
+                            print(f"Skipping {out_pattern.replace('{n}', 'majority')} as it already exists")
+                            continue
+                    this_cmd, affinity = round_command(cmd, model, overrideTemplateMixIn, temp_prompt_file.name)
+                    if "-v" in opts:
+                        print(this_cmd)
+                    outputs, majority, top_votes = self_consistency(this_cmd, affinity, cp, rounds, float(opts.get("-A")), int(opts.get("-J") or 2))
+                    if majority is None:
+                        sys.stderr.write("Error: all samples failed\n")
+                        sys.exit(1)
+                    # Show the first sample that gave the majority answer
+                    majority_n = min(n for n, outs_s in outputs.items() if normalize_answer(outs_s) == majority)
+                    if out_pattern is not None:
+                        for n, outs_s in sorted(outputs.items()):
+                            with open(out_pattern.replace('{n}', str(n)), "w") as f:
+                                f.write(outs_s)
+                        with open(out_pattern.replace('{n}', "majority"), "w") as f:
+                            f.write(outputs[majority_n])
+                    else:
+                        print(outputs[majority_n])
+                    sys.stderr.write(f"Agreement: {top_votes}/{len(outputs)} = {top_votes / len(outputs):.2f} (ran {len(outputs)} of {rounds} samples), answer: {majority}\n")
+                    continue
 
                 for infer_round in range(int(opts.get("-n") or 1)):
                     out_file = opts.get("-o")
-                    if '-m' not in opts: # allow overriding the model if the user did not specify it.
-                        if cp.override_model() is not None:
-                            try:
-                                try_model = glob.glob(f"{MODELS_PATH}/*{cp.override_model()}*.gguf")[0]
-                                if not os.path.isfile(try_model):
-                                    raise Exception(try_model + " exists but is not a file?!")
-                                model = try_model
-                            except Exception as e:
-                                sys.stderr.write(f"Error using {cp.override_model()} as model: {e}")
-                                sys.stderr.write("\n")
-                                sys.stderr.flush()
                     if out_file is not None:
                         out_file = (out_file.
                             replace('{n}', str(infer_round)).
                             replace('{m}', os.path.basename(model)).
-                            replace('{f}', prompt_file))
+                            replace('{f}', prompt_file or "stdin"))
                         if os.path.exists(out_file):
                             print(f"Skipping {out_file} as it already exists")
                             continue
 
-                    this_cmd = cmd.copy()
-                    if 'codellama-70b' in model: # XXX: Temp hack
-                        this_cmd.append("-r")
-                        this_cmd.append("EOT: true")
-                    if 'yi-34b' or 'starling' in model: # XXX: Temp hack
-                        this_cmd.append("-r")
-                        this_cmd.append("<|im_end|>")
-                    if overrideTemplateMixIn == DeepSeekV2LiteMixin:
-                        this_cmd.append("-b")
-                        this_cmd.append("256") # https://github.com/ggerganov/llama.cpp/issues/7652#issuecomment-2140568771
-                    if overrideTemplateMixIn == DeepSeekV25Mixin:  # We don't have enough RAM for 4096
-                        ctx_idx = this_cmd.index("-c")
-                        if ctx_idx < 0:
-                            this_cmd.append("-c")
-                            this_cmd.append("2048")
-                        else:
-                            this_cmd[ctx_idx + 1] = "2048"
-
-                    this_cmd[this_cmd.index(ModelPlaceholder)] = model
-                    this_cmd += ["-f", temp_prompt_file.name]
+                    this_cmd, affinity = round_command(cmd, model, overrideTemplateMixIn, temp_prompt_file.name)
+                    draft_model = None
+                    llama_log = None
+                    if opts.get("-D") != "none" and "-md" not in this_cmd:
+                        import draft
+                        if draft.available():
+                            if draft_model := draft.choose(model, opts.get("-D")):
+                                this_cmd = draft.speculative_command(this_cmd, draft_model)
+                            # Not a pipe, we only read it at the end
+                            llama_log = tempfile.TemporaryFile()
                     if "-v" in opts:
                         print(this_cmd)
-                    p = subprocess.Popen(this_cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
-
-                    if '-o' not in opts and not cp.has_postprocess():
+                    load_fraction = None
+                    if model not in load_checked:
+                        import residency
+                        try:
+                            load_fraction = residency.cached_fraction(model)
+                        except OSError:
+                            pass
+                    started = time.time()
+                    TIMINGS.lap("round_setup")
+                    p = subprocess.Popen(this_cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=llama_log or subprocess.DEVNULL,
+                                         preexec_fn=(lambda: os.sched_setaffinity(0, affinity)) if affinity else None)
+                    TIMINGS.lap("spawn")
+
+                    # The first byte means the model is loaded and the prompt is processed
+                    # Not p.stdout.read(1), which would buffer output that communicate() then never sees
+                    first = os.read(p.stdout.fileno(), 1)
+                    if model not in load_checked:
+                        load_checked.add(model)
+                        if load_fraction is not None:
+                            residency.log_load(model, load_fraction, time.time() - started)
+                    if opts.get("-W") and prefetcher is None:
+                        import residency
+                        if next_model := residency.next_in_schedule(opts.get("-W"), model):
+                            prefetcher = residency.prefetch_in_background([next_model], keep=model)
+
+                    # With a draft the prompt is echoed first (and we might have to rerun), so don't stream
+                    if '-o' not in opts and not cp.has_postprocess() and draft_model is None:
+                        sys.stdout.buffer.write(first)
+                        sys.stdout.flush()
                         while dat := p.stdout.read(1):
                             sys.stdout.buffer.write(dat)
                             sys.stdout.flush()
+                        first = b""
 
                     outs = p.communicate()
+                    outs = (first + (outs[0] or b""), outs[1])
+                    TIMINGS.lap("inference")
+                    if llama_log is not None:
+                        llama_log.seek(0)
+                        outs = (outs[0], llama_log.read())
+                        llama_log.close()
+                        if p.returncode != 0 and draft_model is not None:
+                            sys.stderr.write(f"Warning: llama-speculative failed with draft {os.path.basename(draft_model)}, disabling it and running without\n")
+                            draft.record_failure(model, draft_model, outs[1].decode("utf-8", errors="replace"))
+                            draft_model = None
+                            this_cmd, affinity = round_command(cmd, model, overrideTemplateMixIn, temp_prompt_file.name)
+                            p = subprocess.Popen(this_cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                                 preexec_fn=(lambda: os.sched_setaffinity(0, affinity)) if affinity else None)
+                            outs = p.communicate()
+                        if p.returncode == 0:
+                            draft.record(model, draft_model, outs[1].decode("utf-8", errors="replace"))
 
                     # Check exit code
                     if p.returncode != 0:
@@ -751,6 +1078,9 @@ if __name__ == "__main__":
                         sys.exit(1)
                     else:
                         outs_s = outs[0].decode("utf-8", errors="replace")
+                        if draft_model is not None:
+                            with open(temp_prompt_file.name) as f:
+                                outs_s = draft.strip_prompt_echo(outs_s, f.read())
                         if cp.has_postprocess():
                             outs_s = cp.postprocess(outs_s)
 
@@ -767,3 +1097,4 @@ if __name__ == "__main__":
                                 # results.
 
                             print(outs_s)
+                        TIMINGS.lap("output")
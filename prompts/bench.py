@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+
+"""
+Benchmarks ask.py's own overhead (everything except the actual inference) by
+running it end to end against a fake llama-cli that streams synthetic tokens.
+
+Usage:
+
+bench.py [OPTIONS]
+
+Options:
+
+-h: Show this help message
+-B: Save the results as the new baseline instead of comparing against it
+
+-b file:           Baseline file (default: ~/.cache/ask/bench_baseline.json)
+-n prompts:        Number of prompt files for the glob scenario (default: 100)
+-s size:           Size of each prompt file in bytes (default: 4000)
+-l tokens:         Tokens emitted in the long output scenario (default: 20000)
+-r rate:           Tokens per second emitted by the fake llama-cli, 0 for as fast as possible (default: 0)
+-R repeats:        Runs per scenario, the fastest one is kept (default: 3)
+-T tolerance:      Relative slowdown vs baseline that counts as a regression (default: 0.25)
+
+The per stage timings come from ask.py's StageTimer (ASK_TIMINGS). The
+"inference" stage includes the output copy loop, so the fake llama-cli reports
+how long it spent emitting tokens and the difference is shown as "copy" (which
+therefore also includes starting the fake llama-cli itself).
+Exits with 1 if any stage regressed against the baseline.
+"""
+
+import getopt
+import glob
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+ASK_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "ask.py")
+DEFAULT_BASELINE = os.path.expanduser("~/.cache/ask/bench_baseline.json")
+
+# Ignore differences smaller than this, they are just noise
+NOISE_FLOOR = 0.02
+
+FAKE_LLAMA_CLI = """#!{python}
+import json, os, sys, time
+args = sys.argv[1:]
+with open(args[args.index("-f") + 1]) as f:
+    f.read()  # llama-cli tokenizes the whole prompt before generating
+tokens = int(os.environ.get("FAKE_LLAMA_TOKENS") or 100)
+rate = float(os.environ.get("FAKE_LLAMA_RATE") or 0)
+start = time.perf_counter()
+for i in range(tokens):
+    if rate:
+        delay = start + i / rate - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+    sys.stdout.write(f"tok{{i}} ")
+    sys.stdout.flush()
+sys.stdout.write("\\n")
+sys.stdout.flush()
+with open(os.environ["FAKE_LLAMA_STATS"], "a") as f:
+    f.write(json.dumps({{"tokens": tokens, "elapsed": time.perf_counter() - start}}) + "\\n")
+"""
+
+# A realistically cluttered MODELS_PATH, so model globbing has something to do
+FAKE_MODELS = [f"Filler-{i}B-Instruct-Q5_K_M.gguf" for i in range(300)] + [
+    "Qwen2.5-Bench-0.5B-Instruct-Q4_K_M.gguf",
+    "Big-Bench-70B-Q4_K_M-00001-of-00002.gguf",
+    "Big-Bench-70B-Q4_K_M-00002-of-00002.gguf",
+]
+BENCH_MODEL = "Qwen2.5-Bench-0.5B"
+
+
+def make_sandbox(root, n_prompts, prompt_size):
+    llama = os.path.join(root, "llama-cli")
+    with open(llama, "w") as f:
+        f.write(FAKE_LLAMA_CLI.format(python=sys.executable))
+    os.chmod(llama, 0o755)
+
+    models = os.path.join(root, "models")
+    os.makedirs(models)
+    for name in FAKE_MODELS:
+        open(os.path.join(models, name), "w").close()
+
+    prompts = os.path.join(root, "prompts")
+    os.makedirs(prompts)
+    line = "#!SYSTEM: You are a benchmark.\n" + "The quick brown fox jumps over the lazy dog. 敏捷的狐狸。\n" * (prompt_size // 60 + 1)
+    for i in range(n_prompts):
+        with open(os.path.join(prompts, f"{i:04d}-bench.prompt"), "w") as f:
+            f.write(line[:prompt_size])
+    return llama, models, prompts
+
+
+def run_ask(root, llama, models, ask_args, tokens, rate):
+    timings = os.path.join(root, "timings.json")
+    stats = os.path.join(root, "stats.jsonl")
+    for path in [timings, stats] + glob.glob(os.path.join(root, "prompts", "*.out")):
+        if os.path.exists(path):
+            os.remove(path)
+    env = dict(os.environ,
+        LLAMA_CPP_PATH=llama,
+        MODELS_PATH=models,
+        ASK_TIMINGS=timings,
+        FAKE_LLAMA_STATS=stats,
+        FAKE_LLAMA_TOKENS=str(tokens),
+        FAKE_LLAMA_RATE=str(rate),
+        )
+    start = time.perf_counter()
+    subprocess.run([sys.executable, ASK_PATH] + ask_args, env=env, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, check=True)
+    wall = time.perf_counter() - start
+
+    with open(timings) as f:
+        stages = json.load(f)["totals"]
+    with open(stats) as f:
+        emitted = [json.loads(line) for line in f]
+    stages["copy"] = stages.get("inference", 0.0) - sum(e["elapsed"] for e in emitted)
+    stages["wall"] = wall
+    return stages, sum(e["tokens"] for e in emitted)
+
+
+def bench_templates(repeats=200):
+    """ Renders a prompt with every preset x template mixin combination, in process """
+    sys.path.insert(0, os.path.dirname(ASK_PATH))
+    import ask
+    mixins = [tm for _, tm in ask.NAME_MATCH_OVERRIDE] + [ask.ChatMLTemplateMixin, ask.InstructionTemplateMixin]
+    presets = [ask.EmptyPreset, ask.DefaultPreset, ask.ExplainPreset, ask.SummarizePreset, ask.ReviewPreset, ask.GitCommitSummarizePreset]
+    classes = [type("BenchPrompt", (tm, preset), {}) for tm in mixins for preset in presets]
+    user_prompt = "The quick brown fox jumps over the lazy dog.\n" * 100
+
+    start = time.perf_counter()
+    for _ in range(repeats):
+        for cls in classes:
+            cls(user_prompt, "").templated_prompt()
+    elapsed = time.perf_counter() - start
+    return {"template": elapsed}, repeats * len(classes)
+
+
+def report(name, stages, units, unit_name):
+    total = stages.get("wall") or sum(stages.values())
+    print(f"\n{name}: {units} {unit_name}, {total:.3f}s, {units / total:.1f} {unit_name}/s")
+    for stage, seconds in sorted(stages.items(), key=lambda kv: -kv[1]):
+        print(f"  {stage:<14} {seconds * 1000:10.1f} ms  {seconds / units * 1e6:10.1f} us/{unit_name[:-1]}")
+
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    for scenario, stages in results.items():
+        for stage, seconds in stages.items():
+            old = baseline.get(scenario, {}).get(stage)
+            if old is None:
+                continue
+            if seconds > old * (1 + tolerance) and seconds - old > NOISE_FLOOR:
+                regressions.append(f"{scenario}/{stage}: {old * 1000:.1f} ms -> {seconds * 1000:.1f} ms")
+    return regressions
+
+
+if __name__ == "__main__":
+    opt_list, args = getopt.getopt(sys.argv[1:], "hBb:n:s:l:r:R:T:")
+    opts = dict(opt_list)
+    if "-h" in opts:
+        print(__doc__)
+        sys.exit(0)
+
+    n_prompts = int(opts.get("-n") or 100)
+    prompt_size = int(opts.get("-s") or 4000)
+    long_tokens = int(opts.get("-l") or 20000)
+    rate = float(opts.get("-r") or 0)
+    repeats = int(opts.get("-R") or 3)
+    tolerance = float(opts.get("-T") or 0.25)
+    baseline_path = opts.get("-b") or DEFAULT_BASELINE
+
+    scenarios = {
+        # The prompts/Makefile style run: many prompt files, short outputs written to files
+        "prompt_glob": (["-c", "2048", "-p", "empty", "-n", "1", "-f", "{prompts}/*.prompt", "-o", "{f}.{m}.{n}.out", "-m", BENCH_MODEL], 10, "prompts"),
+        # A single question with a long answer streamed to stdout
+        "long_output": (["-p", "default", "-m", BENCH_MODEL, "Why is the sky blue?"], long_tokens, "tokens"),
+    }
+
+    results = {}
+    with tempfile.TemporaryDirectory() as root:
+        llama, models, prompts = make_sandbox(root, n_prompts, prompt_size)
+        for name, (ask_args, tokens, unit_name) in scenarios.items():
+            ask_args = [a.replace("{prompts}", prompts) for a in ask_args]
+            runs = [run_ask(root, llama, models, ask_args, tokens, rate) for _ in range(repeats)]
+            stages = {stage: min(r[0][stage] for r in runs) for stage in runs[0][0]}
+            units = n_prompts if unit_name == "prompts" else runs[0][1]
+            report(name, stages, units, unit_name)
+            results[name] = stages
+
+    stages, renders = min((bench_templates() for _ in range(repeats)), key=lambda r: r[0]["template"])
+    report("templates", stages, renders, "renders")
+    results["templates"] = stages
+
+    if "-B" in opts:
+        os.makedirs(os.path.dirname(baseline_path) or ".", exist_ok=True)
+        with open(baseline_path, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"\nSaved baseline to {baseline_path}")
+    elif os.path.exists(baseline_path):
+        with open(baseline_path) as f:
+            regressions = compare(results, json.load(f), tolerance)
+        if regressions:
+            print("\nRegressions against baseline:")
+            for r in regressions:
+                print("  " + r)
+            sys.exit(1)
+        print("\nNo regressions against baseline")
+    else:
+        print(f"\nNo baseline at {baseline_path}, run with -B to save one")
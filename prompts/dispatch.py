@@ -0,0 +1,318 @@
+#!/usr/bin/env python3
+
+"""
+Spreads the (model, prompt, round) evaluation matrix over a pool of hosts
+running a llama.cpp completion server (llama-server), and writes the results
+locally with the same naming as ask.py, e.g. '{f}.{m}.{n}.out'.
+
+Usage:
+
+dispatch.py [OPTIONS] -H hosts -m models -f prompt_glob
+dispatch.py -S port [-m model] [-d delay] [-F failure_rate]
+
+Options:
+
+-h: Show this help message
+-v: Verbose
+
+-H hosts:          Comma separated host:port list, or @file with one per line
+-m models:         Comma separated model names (substring matches like ask.py)
+-f file:           Input prompt files (can be a glob)
+-o file:           Output file (default: {f}.{m}.{n}.out)
+-p preset:         Set the preset to use (default: empty)
+-n rounds:         Set the number of rounds to run (default: 1)
+-t temperature:    Set the temperature (default: 0.3 if -n > 1 else 0)
+-x ignore_prefix:  Set the prefix to ignore in the prompt file (default: #!)
+-N n_predict:      Max tokens to generate (default: -1)
+
+Placement: each host is asked which model it has loaded (GET /props). A host
+with a model loaded only gets work for that model. A host that doesn't report
+one (e.g. a llama-swap style proxy that loads models on demand) gets work for
+the model it ran last if there is any left, otherwise for the model with the
+most work left that no other host is on, so that models get swapped as rarely
+as possible. Failed units are retried on any host up to MAX_ATTEMPTS times,
+and a host that fails MAX_HOST_FAILURES times in a row is dropped.
+
+-S runs a stand-in server for trying this out on one machine, e.g.
+
+    dispatch.py -S 8081 -m Llama-3.2-3B-Instruct-Q6_K.gguf &
+    dispatch.py -S 8082 -F 0.2 &
+    dispatch.py -H localhost:8081,localhost:8082 -m Llama-3.2-3B,gemma-2-9b -f '*/*.prompt'
+"""
+
+import collections
+import getopt
+import glob
+import inspect
+import json
+import os
+import sys
+import threading
+import time
+import urllib.request
+
+import ask
+
+MAX_ATTEMPTS = 3
+MAX_HOST_FAILURES = 3
+REQUEST_TIMEOUT = 3600
+
+Unit = collections.namedtuple("Unit", ["model", "prompt_file", "round"])
+
+
+class Host:
+    def __init__(self, address):
+        self.url = address if "://" in address else "http://" + address
+        self.model = None   # basename of the model we believe is loaded
+        self.fixed = False  # True if the server can only serve self.model
+        self.slots = 1
+        self.failures = 0
+        self.alive = True
+
+    def probe(self):
+        try:
+            with urllib.request.urlopen(self.url + "/props", timeout=10) as r:
+                props = json.load(r)
+        except Exception:
+            # Not a plain llama-server, assume it loads whatever we ask for
+            return
+        if props.get("model_path"):
+            self.model = os.path.basename(props["model_path"])
+            self.fixed = True
+        self.slots = max(1, int(props.get("total_slots") or 1))
+
+    def complete(self, model, prompt, temperature, n_predict):
+        body = json.dumps({
+            "model": model,
+            "prompt": prompt,
+            "temperature": temperature,
+            "n_predict": n_predict,
+            "cache_prompt": True,
+        }).encode("utf-8")
+        req = urllib.request.Request(self.url + "/completion", data=body, headers={"Content-Type": "application/json"})
+        with urllib.request.urlopen(req, timeout=REQUEST_TIMEOUT) as r:
+            return json.load(r)["content"]
+
+    def __str__(self):
+        return self.url
+
+
+class Scheduler:
+    def __init__(self, units, hosts):
+        self.pending = collections.OrderedDict()
+        for unit in units:
+            self.pending.setdefault(unit.model, collections.deque()).append(unit)
+        self.hosts = hosts
+        self.attempts = collections.Counter()
+        self.in_flight = 0
+        self.failed = []
+        self.cond = threading.Condition()
+
+    def _servable(self, model):
+        return any(h.alive and (not h.fixed or model_matches(h.model, model)) for h in self.hosts)
+
+    def _pick(self, host):
+        if host.model is not None:
+            for model, units in self.pending.items():
+                if units and model_matches(host.model, model):
+                    return model
+        if host.fixed:
+            return None
+        # Prefer models nobody else is on, then the one with the most work left
+        others = [h.model for h in self.hosts if h is not host and h.alive and h.model]
+        candidates = [m for m, units in self.pending.items() if units]
+        candidates.sort(key=lambda m: (any(model_matches(o, m) for o in others), -len(self.pending[m])))
+        return candidates[0] if candidates else None
+
+    def next_for(self, host):
+        with self.cond:
+            while True:
+                # Give up on work that no remaining host can do
+                for model, units in self.pending.items():
+                    if units and not self._servable(model):
+                        sys.stderr.write(f"Error: no host can serve {model}, dropping {len(units)} units\n")
+                        self.failed += units
+                        units.clear()
+                if not host.alive:
+                    return None
+                model = self._pick(host)
+                if model is not None:
+                    if not host.fixed:
+                        host.model = model
+                    self.in_flight += 1
+                    return self.pending[model].popleft()
+                if self.in_flight == 0:
+                    return None
+                # Something in flight might fail and come back to us
+                self.cond.wait()
+
+    def done(self, unit):
+        with self.cond:
+            self.in_flight -= 1
+            self.cond.notify_all()
+
+    def retry(self, unit, error):
+        with self.cond:
+            self.in_flight -= 1
+            self.attempts[unit] += 1
+            if self.attempts[unit] >= MAX_ATTEMPTS:
+                sys.stderr.write(f"Error: giving up on {unit} after {MAX_ATTEMPTS} attempts: {error}\n")
+                self.failed.append(unit)
+            else:
+                self.pending[unit.model].append(unit)
+            self.cond.notify_all()
+
+    def fail(self, unit):
+        with self.cond:
+            self.in_flight -= 1
+            self.failed.append(unit)
+            self.cond.notify_all()
+
+    def retire(self, host):
+        with self.cond:
+            host.alive = False
+            self.cond.notify_all()
+
+
+def model_matches(loaded, model):
+    return loaded is not None and (loaded == model or os.path.basename(loaded).startswith(model.removesuffix(".gguf")))
+
+
+def resolve_model(name, hosts):
+    """ Returns the file name to use for {m}, like ask.py would get from MODELS_PATH """
+    for host in hosts:
+        if host.model and name.lower() in host.model.lower():
+            return host.model
+    local = sorted(m for m in glob.glob(f"{ask.MODELS_PATH}/*{name}*.gguf") if '-of-000' not in m or '01-of-000' in m)
+    if local:
+        return os.path.basename(local[0])
+    if name.endswith(".gguf"):
+        return name
+    raise ValueError(f"Can't find model {name} locally or on any host, try giving the full .gguf name")
+
+
+def render(preset, model, prompt_file, ignore_prefix):
+    prompt = ask.read_prompt_file(prompt_file, ignore_prefix=ignore_prefix)
+    cp = type("CurrentPrompt", (ask.template_mixin_for(model), preset), {})(prompt["user"], "")
+    if prompt["system"]:
+        cp.set_system_message(prompt["system"])
+    return cp
+
+
+def worker(host, sched, preset, out_pattern, temperature, n_predict, ignore_prefix, verbose):
+    while (unit := sched.next_for(host)) is not None:
+        out_file = out_pattern.replace('{n}', str(unit.round)).replace('{m}', unit.model).replace('{f}', unit.prompt_file)
+        try:
+            cp = render(preset, unit.model, unit.prompt_file, ignore_prefix)
+            start = time.time()
+            outs = host.complete(unit.model, cp.templated_prompt(), temperature, n_predict)
+        except Exception as e:
+            sys.stderr.write(f"Warning: {unit} failed on {host}: {e}\n")
+            host.failures += 1
+            sched.retry(unit, e)
+            if host.failures >= MAX_HOST_FAILURES:
+                sys.stderr.write(f"Error: dropping {host} after {host.failures} failures in a row\n")
+                sched.retire(host)
+            continue
+        host.failures = 0
+        try:
+            if cp.has_postprocess():
+                outs = cp.postprocess(outs)
+            # Write then rename, so a half written file never counts as done
+            with open(out_file + ".tmp", "w") as f:
+                f.write(outs)
+            os.replace(out_file + ".tmp", out_file)
+        except Exception as e:
+            # Our fault, not the host's, and retrying won't help
+            sys.stderr.write(f"Error: can't write {out_file} for {unit}: {e}\n")
+            sched.fail(unit)
+            continue
+        if verbose:
+            print(f"{out_file} ({host}, {time.time() - start:.1f}s)")
+        sched.done(unit)
+
+
+def serve_stand_in(port, model, delay, failure_rate):
+    """ Just enough of llama-server's API to exercise dispatching """
+    import http.server
+    import random
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def _reply(self, code, obj):
+            data = json.dumps(obj).encode("utf-8")
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            if self.path == "/props" and model:
+                self._reply(200, {"model_path": "/models/" + model, "total_slots": 1})
+            else:
+                self._reply(404, {"error": "not found"})
+
+        def do_POST(self):
+            body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            time.sleep(delay)
+            if random.random() < failure_rate:
+                self._reply(500, {"error": "stand-in failure"})
+                return
+            served = model or body.get("model")
+            self._reply(200, {"content": f"[{served} on :{port}] {body['prompt'][-80:]!r}\n", "model": served})
+
+    http.server.ThreadingHTTPServer(("127.0.0.1", port), Handler).serve_forever()
+
+
+if __name__ == "__main__":
+    opt_list, args = getopt.getopt(sys.argv[1:], "hvH:m:f:o:p:n:t:x:N:S:d:F:")
+    opts = dict(opt_list)
+    if "-h" in opts:
+        print(__doc__)
+        sys.exit(0)
+
+    if opts.get("-S"):
+        serve_stand_in(int(opts["-S"]), opts.get("-m"), float(opts.get("-d") or 0.2), float(opts.get("-F") or 0))
+        sys.exit(0)
+
+    presets = {obj.name: obj for _, obj in inspect.getmembers(ask, inspect.isclass) if issubclass(obj, ask.Preset) and obj is not ask.Preset}
+    preset = presets[opts.get("-p") or "empty"]
+
+    host_spec = opts["-H"]
+    if host_spec.startswith("@"):
+        with open(host_spec[1:]) as f:
+            host_spec = ",".join(line.strip() for line in f if line.strip() and not line.startswith("#"))
+    hosts = [Host(h.strip()) for h in host_spec.split(",") if h.strip()]
+    for host in hosts:
+        host.probe()
+        if "-v" in opts:
+            print(f"{host}: {host.model or 'loads on demand'}, {host.slots} slot(s)")
+
+    rounds = int(opts.get("-n") or 1)
+    temperature = float(opts["-t"]) if opts.get("-t") is not None else (0.3 if rounds > 1 else 0.0)
+    out_pattern = opts.get("-o") or "{f}.{m}.{n}.out"
+    models = [resolve_model(m, hosts) for m in opts["-m"].split(",")]
+
+    units = []
+    skipped = 0
+    for model in models:
+        for prompt_file in sorted(glob.glob(opts["-f"])):
+            for infer_round in range(rounds):
+                out_file = out_pattern.replace('{n}', str(infer_round)).replace('{m}', model).replace('{f}', prompt_file)
+                if os.path.exists(out_file):
+                    skipped += 1
+                    continue
+                units.append(Unit(model, prompt_file, infer_round))
+    print(f"{len(units)} units to run on {len(hosts)} hosts ({skipped} already done)")
+
+    sched = Scheduler(units, hosts)
+    threads = [threading.Thread(target=worker, args=(host, sched, preset, out_pattern, temperature, int(opts.get("-N") or -1), opts.get("-x") or "#!", "-v" in opts))
+               for host in hosts for _ in range(host.slots)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    if sched.failed:
+        sys.stderr.write(f"{len(sched.failed)} units failed\n")
+        sys.exit(1)
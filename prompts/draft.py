@@ -0,0 +1,344 @@
+#!/usr/bin/env python3
+
+"""
+Pairs big models with a small model of the same family as the draft for
+speculative decoding (llama.cpp's llama-speculative), and keeps track of
+whether that actually helps.
+
+Usage:
+
+draft.py candidates model    Show the compatible draft models for a model
+draft.py report              Acceptance rate and speedup per pair
+draft.py reset [model]       Forget the measurements (and re-enable the disabled pairs)
+
+A draft is compatible when its GGUF metadata has the same general.architecture
+and the same tokenizer (tokenizer.ggml.model and an identical token list), and
+it is at most MAX_DRAFT_RATIO of the size of the main model. The metadata is
+cached in ~/.cache/ask/gguf_meta.json since reading a token list takes a while.
+
+ask.py runs a model without a draft until it knows its baseline speed (one run,
+or the tune.py profile), then with the best candidate. Every run adds its
+acceptance rate and generation speed to ~/.cache/ask/draft_pairs.json. Once a
+pair has MIN_RUNS runs it is disabled if it isn't at least MIN_SPEEDUP times as
+fast as the baseline, and the next candidate gets its turn. A pair that makes
+llama-speculative fail is disabled right away, and ask.py reruns without it.
+"""
+
+import contextlib
+import fcntl
+import glob
+import hashlib
+import json
+import os
+import re
+import shutil
+import struct
+import sys
+import tempfile
+
+import ask
+import residency
+
+LLAMA_SPECULATIVE_PATH = os.environ.get("LLAMA_SPECULATIVE_PATH") or shutil.which('llama-speculative') or os.path.expanduser("~/projects/llama.gguf/llama-speculative")
+META_CACHE_PATH = os.path.expanduser("~/.cache/ask/gguf_meta.json")
+PAIRS_PATH = os.path.expanduser("~/.cache/ask/draft_pairs.json")
+
+MAX_DRAFT_RATIO = 0.25
+MIN_RUNS = 3
+MIN_SPEEDUP = 1.1
+# llama-cli options that llama-speculative rejects, and how many values they take
+CLI_ONLY_ARGS = {"-no-cnv": 0, "-r": 1, "--reverse-prompt": 1}
+# How much of the end of the prompt to look for in the output, see strip_prompt_echo()
+ECHO_TAIL_CHARS = 200
+
+EVAL_RE = re.compile(r"^\S+:\s+eval time\s*=.*?([\d.]+) tokens per second", re.MULTILINE)
+SPECULATIVE_SPEED_RE = re.compile(r"decoded\s+\d+ tokens in\s+[\d.]+ seconds, speed:\s+([\d.]+) t/s")
+DRAFTED_RE = re.compile(r"n_drafted\s*=\s*(\d+)")
+ACCEPTED_RE = re.compile(r"n_accept\s*=\s*(\d+)")
+
+# GGUF metadata value types
+GGUF_SCALARS = {0: "<B", 1: "<b", 2: "<H", 3: "<h", 4: "<I", 5: "<i", 6: "<f", 7: "<?", 10: "<Q", 11: "<q", 12: "<d"}
+GGUF_STRING = 8
+GGUF_ARRAY = 9
+WANTED_KEYS = ("general.architecture", "tokenizer.ggml.model")
+
+
+def _read_string(f):
+    length, = struct.unpack("<Q", f.read(8))
+    return f.read(length)
+
+
+def _skip_value(f, value_type):
+    if value_type == GGUF_STRING:
+        f.seek(struct.unpack("<Q", f.read(8))[0], os.SEEK_CUR)
+    elif value_type == GGUF_ARRAY:
+        item_type, count = struct.unpack("<IQ", f.read(12))
+        if item_type in GGUF_SCALARS:
+            f.seek(struct.calcsize(GGUF_SCALARS[item_type]) * count, os.SEEK_CUR)
+        else:
+            for _ in range(count):
+                _skip_value(f, item_type)
+    else:
+        f.seek(struct.calcsize(GGUF_SCALARS[value_type]), os.SEEK_CUR)
+
+
+def read_metadata(path):
+    """
+    Returns {"architecture", "tokenizer", "vocab_size", "vocab_sha1"} from the
+    GGUF header (the first shard holds it for split models).
+    """
+    meta = {}
+    with open(path, "rb") as f:
+        magic, version = struct.unpack("<4sI", f.read(8))
+        if magic != b"GGUF" or version < 2:
+            raise ValueError(f"{path} is not a GGUF v2+ file")
+        tensor_count, kv_count = struct.unpack("<QQ", f.read(16))
+        for _ in range(kv_count):
+            key = _read_string(f).decode("utf-8")
+            value_type, = struct.unpack("<I", f.read(4))
+            if key in WANTED_KEYS and value_type == GGUF_STRING:
+                meta[key.split(".")[-1]] = _read_string(f).decode("utf-8")
+            elif key == "tokenizer.ggml.tokens" and value_type == GGUF_ARRAY:
+                item_type, count = struct.unpack("<IQ", f.read(12))
+                sha1 = hashlib.sha1()
+                for _ in range(count):
+                    sha1.update(_read_string(f) + b"\0")
+                meta["vocab_size"] = count
+                meta["vocab_sha1"] = sha1.hexdigest()
+            else:
+                _skip_value(f, value_type)
+    return {"architecture": meta.get("architecture"), "tokenizer": meta.get("model"),
+            "vocab_size": meta.get("vocab_size"), "vocab_sha1": meta.get("vocab_sha1")}
+
+
+def _load_json(path, default):
+    if not os.path.exists(path):
+        return default
+    with open(path) as f:
+        return json.load(f)
+
+
+def _save_json(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # A temp file of our own, other ask.py processes may be saving too
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=os.path.basename(path) + ".")
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(data, f, indent=2)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+@contextlib.contextmanager
+def _updating(path, default):
+    """
+    Loads path, yields it for changing and saves it, all under an exclusive
+    lock so that concurrent ask.py runs don't lose each other's updates
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + ".lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        data = _load_json(path, default)
+        yield data
+        _save_json(path, data)
+
+
+def models_metadata(models):
+    """ Returns {model: metadata and size} using (and updating) the cache """
+    cache = _load_json(META_CACHE_PATH, {})
+    result = {}
+    updated = {}
+    for model in models:
+        st = os.stat(model)
+        entry = cache.get(model)
+        if not entry or entry["mtime_ns"] != st.st_mtime_ns or entry["file_size"] != st.st_size:
+            try:
+                entry = read_metadata(model)
+            except (OSError, ValueError, struct.error, UnicodeDecodeError) as e:
+                sys.stderr.write(f"Warning: can't read GGUF metadata of {model}: {e}\n")
+                entry = {"architecture": None, "tokenizer": None, "vocab_size": None, "vocab_sha1": None}
+            entry.update(mtime_ns=st.st_mtime_ns, file_size=st.st_size,
+                         size=sum(os.path.getsize(shard) for shard in residency.model_shards(model)))
+            updated[model] = entry
+        result[model] = entry
+    if updated:
+        # The GGUFs are read without the lock, it's only held for the merge
+        with _updating(META_CACHE_PATH, {}) as cache:
+            cache.update(updated)
+    return result
+
+
+def compatible(main_meta, draft_meta):
+    return (main_meta["architecture"] is not None and main_meta["vocab_sha1"] is not None
+            and draft_meta["architecture"] == main_meta["architecture"]
+            and draft_meta["tokenizer"] == main_meta["tokenizer"]
+            and draft_meta["vocab_sha1"] == main_meta["vocab_sha1"])
+
+
+def candidates(model):
+    """ Returns the compatible drafts for model in MODELS_PATH, smallest first """
+    def size(m):
+        return sum(os.path.getsize(shard) for shard in residency.model_shards(m))
+
+    max_size = size(model) * MAX_DRAFT_RATIO
+    # Only read the metadata of the ones small enough
+    models = [m for m in sorted(glob.glob(f"{ask.MODELS_PATH}/*.gguf")) if ('-of-000' not in m or '01-of-000' in m)
+              and os.path.realpath(m) != os.path.realpath(model) and size(m) <= max_size]
+    metadata = models_metadata(models + [model])
+    found = [m for m in models if compatible(metadata[model], metadata[m])]
+    return sorted(found, key=lambda m: metadata[m]["size"])
+
+
+def baseline_speed(model, pairs):
+    baseline = pairs["baselines"].get(os.path.basename(model))
+    if baseline and baseline["runs"]:
+        return baseline["tokens_per_second"]
+    profile = ask.tuning_profile(model)
+    return profile.get("tokens_per_second") if profile else None
+
+
+def available():
+    return os.path.exists(LLAMA_SPECULATIVE_PATH)
+
+
+def choose(model, requested=None):
+    """
+    Returns the draft to use for model, or None to run it on its own.
+    requested is a model name to force (still checked for compatibility), or
+    None/"auto" to pick one.
+    """
+    if not available():
+        return None
+    if requested and requested != "auto":
+        draft = glob.glob(f"{ask.MODELS_PATH}/*{requested}*.gguf")[0]
+        metadata = models_metadata([model, draft])
+        if not compatible(metadata[model], metadata[draft]):
+            sys.stderr.write(f"Warning: {os.path.basename(draft)} doesn't look like a compatible draft for {os.path.basename(model)}\n")
+        return draft
+    pairs = _load_json(PAIRS_PATH, {"baselines": {}, "pairs": {}})
+    if baseline_speed(model, pairs) is None:
+        # Measure the model on its own first
+        return None
+    tried = pairs["pairs"].get(os.path.basename(model), {})
+
+    def preference(draft):
+        stats = tried.get(os.path.basename(draft))
+        if stats is None:
+            return (2, 0)
+        if stats["runs"] < MIN_RUNS:
+            return (1, 0)
+        return (0, -stats["tokens_per_second"])
+
+    usable = [d for d in candidates(model) if not tried.get(os.path.basename(d), {}).get("disabled")]
+    # min() is stable, so among the untried ones the smallest wins
+    return min(usable, key=preference) if usable else None
+
+
+def speculative_command(cmd, draft):
+    """ Turns a llama-cli command line into the llama-speculative one with draft """
+    spec = [LLAMA_SPECULATIVE_PATH]
+    args = iter(cmd[1:])
+    for arg in args:
+        if arg in CLI_ONLY_ARGS:
+            for _ in range(CLI_ONLY_ARGS[arg]):
+                next(args)
+            continue
+        spec.append(arg)
+        if arg in ("-n", "--n-predict"):
+            # -2 (fill the context) is llama-cli only, generate until EOS instead
+            n_predict = next(args)
+            spec.append("-1" if n_predict == "-2" else n_predict)
+    spec += ["-md", draft]
+    if "-ngl" in spec:
+        spec += ["-ngld", "99"]
+    return spec
+
+
+def strip_prompt_echo(output, prompt):
+    """
+    llama-speculative prints the prompt before the generated text (and the
+    input_echo patch in ask.py only covers llama-cli). The echo is detokenized,
+    so it may differ at the start (BOS etc.), hence we look for the end.
+    """
+    tail = prompt.strip()[-ECHO_TAIL_CHARS:]
+    if tail and (i := output.find(tail)) >= 0:
+        return output[i + len(tail):].lstrip("\n")
+    return output
+
+
+def record_failure(model, draft, log):
+    """ Disables a pair that made llama-speculative fail, so the next run goes without it """
+    with _updating(PAIRS_PATH, {"baselines": {}, "pairs": {}}) as pairs:
+        stats = pairs["pairs"].setdefault(os.path.basename(model), {}).setdefault(os.path.basename(draft), {
+            "runs": 0, "drafted": 0, "accepted": 0, "tokens_per_second": 0.0, "disabled": False})
+        stats["failures"] = stats.get("failures", 0) + 1
+        stats["disabled"] = True
+        stats["last_error"] = log.strip()[-500:]
+
+
+def record(model, draft, log):
+    """ Adds the speed (and acceptance rate) in the llama.cpp log of one run, and disables pairs that don't help """
+    name = os.path.basename(model)
+    if draft is None:
+        speeds = EVAL_RE.findall(log)
+        if not speeds:
+            return
+        with _updating(PAIRS_PATH, {"baselines": {}, "pairs": {}}) as pairs:
+            stats = pairs["baselines"].setdefault(name, {"runs": 0, "tokens_per_second": 0.0})
+            stats["tokens_per_second"] = (stats["tokens_per_second"] * stats["runs"] + float(speeds[-1])) / (stats["runs"] + 1)
+            stats["runs"] += 1
+        return
+
+    speed = SPECULATIVE_SPEED_RE.search(log)
+    drafted = DRAFTED_RE.search(log)
+    accepted = ACCEPTED_RE.search(log)
+    if not speed:
+        return
+    with _updating(PAIRS_PATH, {"baselines": {}, "pairs": {}}) as pairs:
+        stats = pairs["pairs"].setdefault(name, {}).setdefault(os.path.basename(draft), {
+            "runs": 0, "drafted": 0, "accepted": 0, "tokens_per_second": 0.0, "disabled": False})
+        stats["tokens_per_second"] = (stats["tokens_per_second"] * stats["runs"] + float(speed.group(1))) / (stats["runs"] + 1)
+        stats["runs"] += 1
+        if drafted and accepted:
+            stats["drafted"] += int(drafted.group(1))
+            stats["accepted"] += int(accepted.group(1))
+        baseline = baseline_speed(model, pairs)
+        if stats["runs"] >= MIN_RUNS and baseline and stats["tokens_per_second"] < baseline * MIN_SPEEDUP and not stats["disabled"]:
+            stats["disabled"] = True
+            sys.stderr.write(f"Disabling draft {os.path.basename(draft)} for {name}: {stats['tokens_per_second'] / baseline:.2f}x the speed without it\n")
+
+
+def report():
+    pairs = _load_json(PAIRS_PATH, {"baselines": {}, "pairs": {}})
+    print(f"{'model':<45} {'draft':<40} {'runs':>5} {'accept':>7} {'t/s':>8} {'speedup':>8}")
+    for name in sorted(set(pairs["baselines"]) | set(pairs["pairs"])):
+        baseline = pairs["baselines"].get(name)
+        if baseline:
+            print(f"{name:<45} {'-':<40} {baseline['runs']:>5} {'-':>7} {baseline['tokens_per_second']:>8.2f} {'1.00x':>8}")
+        for draft, stats in sorted(pairs["pairs"].get(name, {}).items()):
+            accept = f"{stats['accepted'] / stats['drafted'] * 100:.1f}%" if stats["drafted"] else "-"
+            speedup = f"{stats['tokens_per_second'] / baseline['tokens_per_second']:.2f}x" if baseline and baseline["tokens_per_second"] else "-"
+            print(f"{name:<45} {draft:<40} {stats['runs']:>5} {accept:>7} {stats['tokens_per_second']:>8.2f} {speedup:>8}"
+                  + (" disabled" if stats["disabled"] else "") + (" (failed)" if stats.get("failures") else ""))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] not in ("candidates", "report", "reset"):
+        print(__doc__)
+        sys.exit(1)
+    command = sys.argv[1]
+    if command == "candidates":
+        model = residency.resolve(sys.argv[2])
+        metadata = models_metadata([model])[model]
+        print(f"{os.path.basename(model)}: {metadata['architecture']}, {metadata['tokenizer']} tokenizer, {metadata['vocab_size']} tokens")
+        for draft in candidates(model):
+            print(f"  {os.path.basename(draft)}")
+    elif command == "report":
+        report()
+    elif command == "reset":
+        with _updating(PAIRS_PATH, {"baselines": {}, "pairs": {}}) as pairs:
+            for name in [os.path.basename(residency.resolve(sys.argv[2]))] if len(sys.argv) > 2 else list(set(pairs["baselines"]) | set(pairs["pairs"])):
+                pairs["baselines"].pop(name, None)
+                pairs["pairs"].pop(name, None)
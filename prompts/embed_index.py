@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+
+"""
+Persistent embedding index of writings/, recipes/ and stream/, used by the
+"retrieve" preset in ask.py to only put the relevant parts of the corpus into
+the prompt.
+
+Usage:
+
+embed_index.py -m model [-k top_k] [QUERY]
+
+-m model:          Embedding model, a path or the first substring match in MODELS_PATH
+-k top_k:          Number of chunks to show (default: 5)
+
+Without a query, just brings the index up to date (the first run embeds the
+whole corpus, which takes a while).
+
+The Markdown files are split into chunks of a few paragraphs, embedded with a
+local GGUF embedding model through llama.cpp's llama-embedding, and stored
+under ~/.cache/ask/embeddings/<model>/ as:
+
+vectors.f32:  A raw float32 matrix (one L2 normalized row per chunk) that we
+              only ever append to, and memory map for searching.
+meta.json:    For each row, the (path, chunk number) it came from, or null if
+              the chunk has been superseded. Plus the mtime/size/sha1 of every
+              indexed file so that updates only re-embed files that changed.
+
+Chunk texts are not stored; the chunking is deterministic so we re-chunk the
+(few) files that have hits. Once more than half the rows are dead the matrix
+is compacted.
+"""
+
+import getopt
+import glob
+import hashlib
+import json
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CORPUS_DIRS = ["writings", "recipes", "stream"]
+INDEX_ROOT = os.path.expanduser("~/.cache/ask/embeddings")
+LLAMA_EMBEDDING_PATH = os.environ.get("LLAMA_EMBEDDING_PATH") or shutil.which('llama-embedding') or os.path.expanduser("~/projects/llama.gguf/llama-embedding")
+
+CHUNK_CHARS = 1000
+EMBED_BATCH = 64
+SEPARATOR = "<#chunk#>"
+DEFAULT_TOP_K = 5
+
+
+def chunk_markdown(text, max_chars=CHUNK_CHARS):
+    """ Splits on blank lines and packs paragraphs into chunks of up to max_chars """
+    chunks = []
+    current = ""
+    for para in re.split(r"\n\s*\n", text):
+        para = para.strip()
+        while len(para) > max_chars:
+            # Some of the writings are one giant paragraph
+            if current:
+                chunks.append(current)
+                current = ""
+            chunks.append(para[:max_chars])
+            para = para[max_chars:]
+        if not para:
+            continue
+        if current and len(current) + len(para) + 2 > max_chars:
+            chunks.append(current)
+            current = para
+        else:
+            current = current + "\n\n" + para if current else para
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def corpus_files():
+    for d in CORPUS_DIRS:
+        for root, directories, files in os.walk(os.path.join(REPO_ROOT, d)):
+            for fn in sorted(files):
+                if fn.endswith(".md"):
+                    yield os.path.relpath(os.path.join(root, fn), REPO_ROOT)
+
+
+def embed(model_path, texts):
+    """ Returns the L2 normalized embeddings of texts as a (len(texts), dim) float32 array """
+    import numpy as np
+    with tempfile.NamedTemporaryFile(mode="w") as f:
+        f.write(SEPARATOR.join(t.replace(SEPARATOR, " ") for t in texts))
+        f.flush()
+        p = subprocess.run([LLAMA_EMBEDDING_PATH, "-m", model_path, "-f", f.name,
+                            "--embd-separator", SEPARATOR, "--embd-output-format", "json", "--embd-normalize", "2",
+                            "-c", "2048", "-b", "2048", "-ub", "2048"],
+                           stdin=subprocess.DEVNULL, capture_output=True)
+    if p.returncode != 0:
+        raise RuntimeError("llama-embedding failed: " + p.stderr.decode("utf-8", errors="replace")[-1000:])
+    out = p.stdout.decode("utf-8")
+    data = json.loads(out[out.index("{"):])["data"]
+    vectors = np.array([d["embedding"] for d in sorted(data, key=lambda d: d["index"])], dtype=np.float32)
+    assert len(vectors) == len(texts), (len(vectors), len(texts))
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+class EmbeddingIndex:
+    def __init__(self, model_path, index_root=INDEX_ROOT):
+        self.model_path = model_path
+        self.dir = os.path.join(index_root, os.path.basename(model_path))
+        os.makedirs(self.dir, exist_ok=True)
+        self.vectors_path = os.path.join(self.dir, "vectors.f32")
+        self.meta_path = os.path.join(self.dir, "meta.json")
+        if os.path.exists(self.meta_path):
+            with open(self.meta_path) as f:
+                self.meta = json.load(f)
+        else:
+            self.meta = {"dim": None, "rows": [], "files": {}}
+        # Drop vectors appended by a run that died before saving meta.json
+        if self.meta["dim"] is not None:
+            with open(self.vectors_path, "ab") as f:
+                f.truncate(len(self.meta["rows"]) * self.meta["dim"] * 4)
+
+    def _save_meta(self):
+        tmp_path = self.meta_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.meta, f)
+        os.replace(tmp_path, self.meta_path)
+
+    def _matrix(self):
+        import numpy as np
+        rows = len(self.meta["rows"])
+        if rows == 0:
+            return np.zeros((0, self.meta["dim"] or 0), dtype=np.float32)
+        return np.memmap(self.vectors_path, dtype=np.float32, mode="r", shape=(rows, self.meta["dim"]))
+
+    def update(self, verbose=False):
+        rows = self.meta["rows"]
+        files = self.meta["files"]
+        seen = set()
+        pending = []  # (path, chunk_no, text)
+        complete = {}
+        for path in corpus_files():
+            seen.add(path)
+            st = os.stat(os.path.join(REPO_ROOT, path))
+            entry = files.get(path)
+            if entry and entry["mtime_ns"] == st.st_mtime_ns and entry["size"] == st.st_size:
+                continue
+            with open(os.path.join(REPO_ROOT, path), "rb") as f:
+                content = f.read()
+            sha1 = hashlib.sha1(content).hexdigest()
+            if entry and entry["sha1"] == sha1:
+                entry.update(mtime_ns=st.st_mtime_ns, size=st.st_size)
+                continue
+            for i in (entry or {}).get("rows", []):
+                rows[i] = None
+            # The stat and sha1 are only filled in once all the chunks are in,
+            # so a file that was cut off half way gets redone next time
+            files[path] = {"mtime_ns": None, "size": None, "sha1": None, "rows": []}
+            chunks = chunk_markdown(content.decode("utf-8", errors="replace"))
+            complete[path] = {"mtime_ns": st.st_mtime_ns, "size": st.st_size, "sha1": sha1, "chunks": len(chunks)}
+            for n, text in enumerate(chunks):
+                pending.append((path, n, text))
+
+        for path in set(files) - seen:
+            for i in files.pop(path)["rows"]:
+                rows[i] = None
+
+        for start in range(0, len(pending), EMBED_BATCH):
+            batch = pending[start:start + EMBED_BATCH]
+            if verbose:
+                sys.stderr.write(f"Embedding chunks {start + 1}-{start + len(batch)} of {len(pending)}\n")
+            vectors = embed(self.model_path, [text for _, _, text in batch])
+            if self.meta["dim"] is None:
+                self.meta["dim"] = vectors.shape[1]
+            with open(self.vectors_path, "ab") as f:
+                vectors.tofile(f)
+            for path, n, _ in batch:
+                files[path]["rows"].append(len(rows))
+                rows.append([path, n])
+            self._mark_complete(complete)
+            # Save as we go so an interrupted first run isn't wasted
+            self._save_meta()
+
+        self._mark_complete(complete)
+        dead = sum(1 for r in rows if r is None)
+        if dead and dead * 2 > len(rows):
+            self._compact()
+        else:
+            self._save_meta()
+
+    def _mark_complete(self, complete):
+        for path, done in list(complete.items()):
+            entry = self.meta["files"][path]
+            if len(entry["rows"]) == done["chunks"]:
+                entry.update(mtime_ns=done["mtime_ns"], size=done["size"], sha1=done["sha1"])
+                del complete[path]
+
+    def _compact(self):
+        import numpy as np
+        live = [i for i, r in enumerate(self.meta["rows"]) if r is not None]
+        vectors = np.array(self._matrix()[live])
+        tmp_path = self.vectors_path + ".tmp"
+        vectors.tofile(tmp_path)
+        remap = {old: new for new, old in enumerate(live)}
+        self.meta["rows"] = [self.meta["rows"][i] for i in live]
+        for entry in self.meta["files"].values():
+            entry["rows"] = [remap[i] for i in entry["rows"]]
+        os.replace(tmp_path, self.vectors_path)
+        self._save_meta()
+
+    def search(self, query, k=DEFAULT_TOP_K):
+        """ Returns [(score, path, text)] of the top k chunks, best first """
+        import numpy as np
+        rows = self.meta["rows"]
+        if not rows:
+            return []
+        scores = self._matrix() @ embed(self.model_path, [query])[0]
+        scores[np.array([r is None for r in rows])] = -np.inf
+        k = min(k, len(rows))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+
+        chunks = {}
+        results = []
+        for i in top:
+            if rows[i] is None:
+                continue
+            path, n = rows[i]
+            if path not in chunks:
+                with open(os.path.join(REPO_ROOT, path), "rb") as f:
+                    chunks[path] = chunk_markdown(f.read().decode("utf-8", errors="replace"))
+            results.append((float(scores[i]), path, chunks[path][n]))
+        return results
+
+
+def retrieve(query, model_path, k=DEFAULT_TOP_K):
+    index = EmbeddingIndex(model_path)
+    index.update(verbose=True)
+    return index.search(query, k)
+
+
+if __name__ == "__main__":
+    opt_list, args = getopt.getopt(sys.argv[1:], "hm:k:")
+    opts = dict(opt_list)
+    if "-h" in opts or not opts.get("-m"):
+        print(__doc__)
+        sys.exit(0 if "-h" in opts else 1)
+
+    model = opts["-m"]
+    if not os.path.isfile(model):
+        models_path = os.environ.get("MODELS_PATH") or os.path.expanduser("~/Downloads/")
+        model = sorted(glob.glob(f"{models_path}/*{model}*.gguf"))[0]
+    index = EmbeddingIndex(model)
+    index.update(verbose=True)
+    if args:
+        for score, path, text in index.search(" ".join(args), int(opts.get("-k") or DEFAULT_TOP_K)):
+            print(f"\033[1m{score:.3f} {path}\033[0m\n{text}\n")
@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+
+"""
+Keeps model files in the page cache so that switching models in long eval runs
+(see the Makefile) isn't I/O bound.
+
+Usage:
+
+residency.py status models...    Show how much of each model is in the page cache
+residency.py prefetch [-k model] models...
+                                 Pull the models into the page cache (ask.py -W runs this in the background),
+                                 leaving -k's pages alone (the model that is generating right now)
+residency.py pin models...       Keep the models resident until killed (for small, frequently used models)
+residency.py report              Cold vs warm time to first token, from what ask.py logged
+
+Models are paths, or substrings matched in MODELS_PATH like ask.py. Split
+GGUFs are handled as a whole (all the -0000N-of-0000M shards).
+
+ask.py logs for every model it starts how much of it was cached and how long it
+took until the first byte of output, to ~/.cache/ask/model_loads.jsonl. A
+load counts as cold when less than half the model was cached.
+"""
+
+import ctypes
+import ctypes.util
+import datetime
+import glob
+import json
+import mmap
+import os
+import re
+import subprocess
+import sys
+import time
+
+LOADS_PATH = os.path.expanduser("~/.cache/ask/model_loads.jsonl")
+CHUNK = 64 * 1024 * 1024
+# Leave this much of MemAvailable alone when prefetching, for everything else
+RESERVE_BYTES = 2 * 1024 * 1024 * 1024
+PIN_TOUCH_INTERVAL = 60
+# Maps each mincore() byte to its resident bit
+RESIDENT_BIT = bytes(b & 1 for b in range(256))
+
+_libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+_libc.mmap.restype = ctypes.c_void_p
+_libc.mmap.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.c_int, ctypes.c_int, ctypes.c_int, ctypes.c_long]
+_libc.munmap.argtypes = [ctypes.c_void_p, ctypes.c_size_t]
+_libc.mincore.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.c_char_p]
+_libc.mlock.argtypes = [ctypes.c_void_p, ctypes.c_size_t]
+MAP_FAILED = ctypes.c_void_p(-1).value
+
+
+def model_shards(model):
+    """ Returns all the files of a (possibly split) model """
+    m = re.match(r"(.*-)\d{5}(-of-\d{5}\.gguf)$", model)
+    if m:
+        return sorted(glob.glob(glob.escape(m.group(1)) + "[0-9]" * 5 + glob.escape(m.group(2))))
+    return [model]
+
+
+def resolve(name):
+    if os.path.isfile(name):
+        return name
+    models_path = os.environ.get("MODELS_PATH") or os.path.expanduser("~/Downloads/")
+    matches = [m for m in sorted(glob.glob(f"{models_path}/*{name}*.gguf")) if '-of-000' not in m or '01-of-000' in m]
+    if not matches:
+        raise ValueError(f"No model matching {name} in {models_path}")
+    return matches[0]
+
+
+def _map(path):
+    """ Returns (fd, address, size) of a read only shared mapping, address is None for empty files """
+    fd = os.open(path, os.O_RDONLY)
+    size = os.fstat(fd).st_size
+    if size == 0:
+        return fd, None, 0
+    addr = _libc.mmap(None, size, mmap.PROT_READ, mmap.MAP_SHARED, fd, 0)
+    if addr == MAP_FAILED:
+        os.close(fd)
+        raise OSError(ctypes.get_errno(), "mmap failed", path)
+    return fd, addr, size
+
+
+def cached_bytes(path):
+    """ Returns (bytes in the page cache, size) using mincore() """
+    fd, addr, size = _map(path)
+    try:
+        if addr is None:
+            return 0, 0
+        pages = (size + mmap.PAGESIZE - 1) // mmap.PAGESIZE
+        vec = ctypes.create_string_buffer(pages)
+        if _libc.mincore(addr, size, vec) != 0:
+            raise OSError(ctypes.get_errno(), "mincore failed", path)
+        # Only the lowest bit means resident, count those without a Python loop
+        resident = len(vec.raw) - vec.raw.translate(RESIDENT_BIT).count(0)
+        return min(resident * mmap.PAGESIZE, size), size
+    finally:
+        if addr is not None:
+            _libc.munmap(addr, size)
+        os.close(fd)
+
+
+def cached_fraction(model):
+    """ Returns the fraction of the model in the page cache, None for empty files """
+    cached = total = 0
+    for shard in model_shards(model):
+        c, t = cached_bytes(shard)
+        cached += c
+        total += t
+    return cached / total if total else None
+
+
+def next_in_schedule(spec, current):
+    """
+    For ask.py -W. spec is either a model, or @file listing models one per
+    line (relative to MODELS_PATH) in the order they will be run, in which case
+    the one after current is returned. Returns None if there is none.
+    """
+    if not spec.startswith("@"):
+        return resolve(spec)
+    models_path = os.environ.get("MODELS_PATH") or os.path.expanduser("~/Downloads/")
+    with open(spec[1:]) as f:
+        schedule = [line.strip() for line in f if line.strip()]
+    paths = [os.path.realpath(m if os.path.isabs(m) else os.path.join(models_path, m)) for m in schedule]
+    current = os.path.realpath(current)
+    if current in paths and paths.index(current) + 1 < len(paths):
+        return paths[paths.index(current) + 1]
+    return None
+
+
+def available_memory():
+    """ MemAvailable on Linux, None elsewhere (i.e. no limit) """
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def prefetch(model, keep=None):
+    """
+    Reads the model into the page cache in chunks, within the memory we can
+    spare. MemAvailable counts clean page cache as reclaimable, which includes
+    the mmap'd pages of keep (the model generating right now), so those are
+    taken out of the budget: we only read as much as fits without the kernel
+    having to reclaim them. That is a budget, not a lock; if the other
+    reclaimable memory is hotter than keep's pages they can still be evicted.
+    """
+    budget = available_memory()
+    if budget is not None:
+        budget -= RESERVE_BYTES
+        if keep is not None:
+            budget -= sum(cached_bytes(shard)[0] for shard in model_shards(keep))
+    for shard in model_shards(model):
+        with open(shard, "rb", buffering=0) as f:
+            size = os.fstat(f.fileno()).st_size
+            for offset in range(0, size, CHUNK):
+                length = min(CHUNK, size - offset)
+                if budget is not None:
+                    if budget < length:
+                        return
+                    budget -= length
+                if hasattr(os, "posix_fadvise"):
+                    os.posix_fadvise(f.fileno(), offset, length, os.POSIX_FADV_WILLNEED)
+                else:
+                    # No fadvise on macOS, just read it
+                    f.seek(offset)
+                    f.read(length)
+
+
+def prefetch_in_background(models, keep=None):
+    """ Starts a low priority, detached residency.py prefetch and returns right away """
+    return subprocess.Popen([sys.executable, os.path.abspath(__file__), "prefetch"] + (["-k", keep] if keep else []) + models,
+                            stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                            start_new_session=True, preexec_fn=lambda: os.nice(19))
+
+
+def pin(models):
+    """ Maps the models and mlock()s them, or keeps touching them if we're not allowed to lock that much """
+    mappings = []
+    for model in models:
+        for shard in model_shards(model):
+            fd, addr, size = _map(shard)
+            if addr is None:
+                continue
+            locked = _libc.mlock(addr, size) == 0
+            if not locked:
+                sys.stderr.write(f"Warning: mlock failed for {shard} ({os.strerror(ctypes.get_errno())}), touching it every {PIN_TOUCH_INTERVAL}s instead\n")
+            mappings.append((shard, fd, addr, size, locked))
+    while True:
+        for shard, fd, addr, size, locked in mappings:
+            if not locked:
+                # Reading one byte per page keeps it recently used
+                for offset in range(0, size, mmap.PAGESIZE):
+                    ctypes.c_char.from_address(addr + offset).value
+        time.sleep(PIN_TOUCH_INTERVAL)
+
+
+def log_load(model, fraction, first_byte_seconds):
+    os.makedirs(os.path.dirname(LOADS_PATH), exist_ok=True)
+    with open(LOADS_PATH, "a") as f:
+        f.write(json.dumps({
+            "time": datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+            "model": os.path.basename(model),
+            "cached_fraction": round(fraction, 3),
+            "first_byte_seconds": round(first_byte_seconds, 3),
+        }) + "\n")
+
+
+def report():
+    stats = {}
+    with open(LOADS_PATH) as f:
+        for line in f:
+            entry = json.loads(line)
+            kind = "warm" if entry["cached_fraction"] >= 0.5 else "cold"
+            stats.setdefault(entry["model"], {"cold": [], "warm": []})[kind].append(entry["first_byte_seconds"])
+    print(f"{'model':<60} {'cold':>14} {'warm':>14}")
+    for model, s in sorted(stats.items()):
+        cols = [f"{sum(v) / len(v):7.1f}s x{len(v):<4}" if v else f"{'-':>14}" for v in (s["cold"], s["warm"])]
+        print(f"{model:<60} {cols[0]:>14} {cols[1]:>14}")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] not in ("status", "prefetch", "pin", "report"):
+        print(__doc__)
+        sys.exit(1)
+    command = sys.argv[1]
+    if command == "report":
+        report()
+        sys.exit(0)
+    names = sys.argv[2:]
+    keep = None
+    if command == "prefetch" and names[:1] == ["-k"]:
+        keep, names = resolve(names[1]), names[2:]
+    models = [resolve(name) for name in names]
+    if command == "status":
+        for model in models:
+            print(f"{(cached_fraction(model) or 0) * 100:5.1f}% {model}")
+    elif command == "prefetch":
+        for model in models:
+            prefetch(model, keep)
+    elif command == "pin":
+        pin(models)
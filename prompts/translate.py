@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+
+"""
+Translates Markdown articles paragraph by paragraph with ask.py's "translate"
+preset, remembering every translated paragraph so that re-translating an edited
+article only sends the paragraphs that changed to the model.
+
+Usage:
+
+translate.py [OPTIONS] articles...
+
+Options:
+
+-h: Show this help message
+-v: Verbose
+
+-m model:          Set the model to use (default: ask.py's DEFAULT_MODEL)
+-l language:       Target language (default: English)
+-o file:           Output file, {f} is the article and {l} the language (default: stdout, only for a single article)
+-j jobs:           Paragraphs to translate in parallel (default: 1 locally, the number of server slots with -H)
+-H hosts:          Translate on llama-server hosts instead of running ask.py locally (same format as dispatch.py)
+
+The translation memory lives in ~/.cache/ask/translation_memory.jsonl and is
+keyed by the SHA-256 of (model, language, source paragraph). It is appended
+to as soon as each paragraph is done, so an interrupted run loses nothing.
+"""
+
+import getopt
+import hashlib
+import json
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import ask
+import dispatch
+
+ASK_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "ask.py")
+MEMORY_PATH = os.path.expanduser("~/.cache/ask/translation_memory.jsonl")
+
+
+def split_paragraphs(text):
+    """
+    Returns a list of [paragraph, separator, paragraph, separator, ...] that
+    joins back into text exactly. Fenced code blocks stay in one piece.
+    """
+    pieces = re.split(r"(\n[ \t]*\n+)", text)
+    result = [pieces[0]]
+    in_fence = pieces[0].count("```") % 2 == 1
+    for separator, paragraph in zip(pieces[1::2], pieces[2::2]):
+        if in_fence:
+            result[-1] += separator + paragraph
+        else:
+            result += [separator, paragraph]
+        if paragraph.count("```") % 2 == 1:
+            in_fence = not in_fence
+    return result
+
+
+def needs_translation(paragraph):
+    stripped = paragraph.strip()
+    if not stripped or stripped.startswith("```"):
+        return False
+    # Horizontal rules, bare links, images, etc.
+    return re.search(r"\w", re.sub(r"\(?https?://\S+\)?|!\[[^\]]*\]\([^)]*\)", "", stripped)) is not None
+
+
+def memory_key(model, language, paragraph):
+    return hashlib.sha256("\0".join([model, language, paragraph]).encode("utf-8")).hexdigest()
+
+
+class TranslationMemory:
+    def __init__(self, path=MEMORY_PATH):
+        self.path = path
+        self.entries = {}
+        self.lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    if line.strip():
+                        entry = json.loads(line)
+                        self.entries[entry["key"]] = entry["translation"]
+
+    def get(self, key):
+        return self.entries.get(key)
+
+    def put(self, key, model, language, source, translation):
+        with self.lock:
+            self.entries[key] = translation
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(self.path, "a") as f:
+                f.write(json.dumps({"key": key, "model": model, "language": language, "source": source, "translation": translation}, ensure_ascii=False) + "\n")
+
+
+def translate_locally(model, language, paragraph):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        out_file = os.path.join(tmp_dir, "translation.out")
+        # ask.py globs *{name}*.gguf, so the name can't end with .gguf itself
+        p = subprocess.run([sys.executable, ASK_PATH, "-q", "-p", "translate", "-t", "0", "-m", model.removesuffix(".gguf"), "-C", language, "-o", out_file],
+                           input=paragraph.encode("utf-8"), stdout=subprocess.DEVNULL)
+        if p.returncode != 0:
+            raise RuntimeError(f"ask.py failed with exit code {p.returncode}")
+        with open(out_file) as f:
+            return f.read().strip()
+
+
+def translate_on(host, model, language, paragraph):
+    cp = type("CurrentPrompt", (ask.template_mixin_for(model), ask.TranslatePreset), {})(paragraph, language)
+    return cp.postprocess(host.complete(model, cp.templated_prompt(), 0.0, -1))
+
+
+if __name__ == "__main__":
+    opt_list, args = getopt.getopt(sys.argv[1:], "hvm:l:o:j:H:")
+    opts = dict(opt_list)
+    if "-h" in opts or not args:
+        print(__doc__)
+        sys.exit(0 if "-h" in opts else 1)
+    if len(args) > 1 and "{f}" not in (opts.get("-o") or ""):
+        sys.stderr.write("Error: use -o with {f} for more than one article\n")
+        sys.exit(1)
+
+    language = opts.get("-l") or "English"
+    hosts = []
+    if opts.get("-H"):
+        host_spec = opts["-H"]
+        if host_spec.startswith("@"):
+            with open(host_spec[1:]) as f:
+                host_spec = ",".join(line.strip() for line in f if line.strip() and not line.startswith("#"))
+        hosts = [dispatch.Host(h.strip()) for h in host_spec.split(",") if h.strip()]
+        for host in hosts:
+            host.probe()
+    model = dispatch.resolve_model(opts.get("-m") or ask.DEFAULT_MODEL, hosts)
+    hosts = [h for h in hosts if not h.fixed or dispatch.model_matches(h.model, model)]
+    if opts.get("-H") and not hosts:
+        sys.stderr.write(f"Error: no host can serve {model}\n")
+        sys.exit(1)
+
+    memory = TranslationMemory()
+    articles = {}
+    todo = {}
+    for article in args:
+        with open(article) as f:
+            pieces = split_paragraphs(f.read())
+        articles[article] = pieces
+        for paragraph in pieces[::2]:
+            key = memory_key(model, language, paragraph.strip())
+            if needs_translation(paragraph) and memory.get(key) is None:
+                todo[key] = paragraph.strip()
+    if "-v" in opts:
+        total = sum(1 for pieces in articles.values() for p in pieces[::2] if needs_translation(p))
+        sys.stderr.write(f"{len(todo)} of {total} paragraphs need translating with {model}\n")
+
+    # Round robin over server slots, one paragraph per slot at a time
+    slots = [host for host in hosts for _ in range(host.slots)]
+    jobs = int(opts.get("-j") or len(slots) or 1)
+    lock = threading.Lock()
+    counter = iter(range(len(todo)))
+
+    def translate(item):
+        key, paragraph = item
+        with lock:
+            n = next(counter)
+        if slots:
+            translation = translate_on(slots[n % len(slots)], model, language, paragraph)
+        else:
+            translation = translate_locally(model, language, paragraph)
+        memory.put(key, model, language, paragraph, translation)
+        if "-v" in opts:
+            sys.stderr.write(f"[{n + 1}/{len(todo)}] {paragraph[:40]!r}\n")
+
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        for _ in pool.map(translate, todo.items()):
+            pass
+
+    def reassemble(pieces):
+        for i, piece in enumerate(pieces):
+            if i % 2 == 1 or not needs_translation(piece):
+                yield piece
+                continue
+            # Keep the whitespace around the paragraph, e.g. the final newline
+            core = piece.strip()
+            start = piece.index(core)
+            yield piece[:start] + (memory.get(memory_key(model, language, core)) or core) + piece[start + len(core):]
+
+    for article, pieces in articles.items():
+        out = "".join(reassemble(pieces))
+        if opts.get("-o"):
+            with open(opts["-o"].replace("{f}", article).replace("{l}", language), "w") as f:
+                f.write(out)
+        else:
+            sys.stdout.write(out)
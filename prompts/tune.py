@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+
+"""
+Finds the fastest llama.cpp thread count, batch size and CPU affinity for a
+model on this (Linux, CPU only) machine, and saves it as a profile that ask.py
+picks up automatically.
+
+Usage:
+
+tune.py [OPTIONS] -m model
+
+Options:
+
+-h: Show this help message
+-v: Print the llama.cpp command lines
+
+-m model:          Set the model to use (substring match in MODELS_PATH, like ask.py)
+-n tokens:         Tokens to generate per calibration pass (default: 32)
+-r repeats:        Passes per configuration, the best one counts (default: 1)
+-x:                Don't save the profile, just report
+
+Calibration happens in two stages, since generation speed mostly depends on
+the thread count and placement, while prompt processing also depends on the
+batch size:
+
+1. For each CPU layout (all logical CPUs, one thread per physical core, and
+   the physical cores of each NUMA node on multi-socket machines) try a few
+   thread counts and measure generation tokens/s.
+2. For the best one, try a few batch sizes and batch thread counts and
+   measure prompt tokens/s.
+
+Profiles live in ~/.cache/ask/tuning.json, keyed by model file name.
+"""
+
+import getopt
+import glob
+import json
+import os
+import re
+import subprocess
+import sys
+
+import ask
+
+# About 200 tokens, long enough for the prompt eval timing to mean something
+CALIBRATION_PROMPT = "Here is a story about a lighthouse keeper who finds a message in a bottle. " * 12
+
+TIMING_RE = re.compile(r"^\S+:\s+(prompt eval|eval) time\s*=.*?([\d.]+) tokens per second", re.MULTILINE)
+
+
+def read_cpulist(path):
+    """ Parses the "0-3,8-11" format used all over /sys """
+    cpus = []
+    with open(path) as f:
+        for part in f.read().strip().split(","):
+            if "-" in part:
+                lo, hi = part.split("-")
+                cpus += range(int(lo), int(hi) + 1)
+            elif part:
+                cpus.append(int(part))
+    return cpus
+
+
+def cpu_layouts():
+    """ Returns {name: sorted list of CPUs} for the placements worth trying """
+    online = read_cpulist("/sys/devices/system/cpu/online")
+    physical = sorted({min(read_cpulist(f"/sys/devices/system/cpu/cpu{cpu}/topology/thread_siblings_list")) for cpu in online})
+    layouts = {"all": online}
+    if physical != online:
+        layouts["physical"] = physical
+    nodes = sorted(glob.glob("/sys/devices/system/node/node[0-9]*"))
+    if len(nodes) > 1:
+        for node in nodes:
+            cpus = sorted(set(read_cpulist(os.path.join(node, "cpulist"))) & set(physical))
+            if cpus:
+                layouts[os.path.basename(node)] = cpus
+    return layouts
+
+
+def thread_counts(n):
+    return sorted({max(1, n // 2), max(1, n * 3 // 4), max(1, n - 1), n})
+
+
+def calibrate(model, config, n_predict, repeats, verbose):
+    """ Returns (prompt tokens/s, generation tokens/s) for the best of repeats passes """
+    cmd = [ask.LLAMA_CPP_PATH, "-m", model, "-no-cnv", "--temp", "0", "-c", "1024", "-n", str(n_predict), "-p", CALIBRATION_PROMPT] + ask.tuning_args(config)
+    if verbose:
+        print(cmd)
+    best = (0.0, 0.0)
+    for _ in range(repeats):
+        p = subprocess.run(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                           preexec_fn=lambda: os.sched_setaffinity(0, config["cpus"]))
+        timings = dict(TIMING_RE.findall(p.stderr.decode("utf-8", errors="replace")))
+        if p.returncode != 0 or "eval" not in timings:
+            sys.stderr.write(f"Warning: calibration failed for {config}\n")
+            continue
+        result = (float(timings.get("prompt eval", 0)), float(timings["eval"]))
+        best = max(best, result, key=lambda r: r[1])
+    return best
+
+
+def report(config, prompt_tps, gen_tps):
+    print(f"{config['layout']:<10} {len(config['cpus']):>4} cpus  -t {config['threads']:<3} -tb {config['threads_batch']:<3} -b {config['batch']:<5}"
+          f"{' --numa ' + config['numa'] if config.get('numa') else '':<18} prompt {prompt_tps:8.2f} t/s   gen {gen_tps:8.2f} t/s")
+
+
+if __name__ == "__main__":
+    opt_list, args = getopt.getopt(sys.argv[1:], "hvm:n:r:x")
+    opts = dict(opt_list)
+    if "-h" in opts or not opts.get("-m"):
+        print(__doc__)
+        sys.exit(0 if "-h" in opts else 1)
+
+    models = [m for m in sorted(glob.glob(f"{ask.MODELS_PATH}/*{opts['-m']}*.gguf")) if '-of-000' not in m or '01-of-000' in m]
+    if not models:
+        sys.stderr.write(f"Error: no model matching {opts['-m']} in {ask.MODELS_PATH}\n")
+        sys.exit(1)
+    model = models[0]
+    n_predict = int(opts.get("-n") or 32)
+    repeats = int(opts.get("-r") or 1)
+    verbose = "-v" in opts
+    layouts = cpu_layouts()
+    multi_node = any(name.startswith("node") for name in layouts)
+    print(f"Tuning {os.path.basename(model)} over layouts: " + ", ".join(f"{name} ({len(cpus)} cpus)" for name, cpus in layouts.items()))
+
+    # Stage 1: layout and thread count, by generation speed
+    best = None
+    for name, cpus in layouts.items():
+        for threads in thread_counts(len(cpus)):
+            config = {"layout": name, "cpus": cpus, "threads": threads, "threads_batch": threads, "batch": 512,
+                      # Spread over the nodes if we use more than one, otherwise let the pinning do the job
+                      "numa": "distribute" if multi_node and not name.startswith("node") else None}
+            prompt_tps, gen_tps = calibrate(model, config, n_predict, repeats, verbose)
+            report(config, prompt_tps, gen_tps)
+            if best is None or gen_tps > best[2]:
+                best = (config, prompt_tps, gen_tps)
+
+    # Stage 2: batch size and batch threads, by prompt speed
+    config, best_prompt_tps, best_gen_tps = best
+    for threads_batch in sorted({config["threads"], len(config["cpus"])}):
+        for batch in (256, 512, 2048):
+            candidate = dict(config, threads_batch=threads_batch, batch=batch)
+            if candidate == config:
+                continue
+            prompt_tps, gen_tps = calibrate(model, candidate, n_predict, repeats, verbose)
+            report(candidate, prompt_tps, gen_tps)
+            if prompt_tps > best_prompt_tps:
+                config, best_prompt_tps, best_gen_tps = candidate, prompt_tps, gen_tps
+
+    print("\nBest:")
+    report(config, best_prompt_tps, best_gen_tps)
+    if best_gen_tps <= 0:
+        sys.stderr.write("Error: no configuration worked, not saving a profile\n")
+        sys.exit(1)
+    if "-x" not in opts:
+        profiles = {}
+        if os.path.exists(ask.TUNING_PROFILES_PATH):
+            with open(ask.TUNING_PROFILES_PATH) as f:
+                profiles = json.load(f)
+        profiles[os.path.basename(model)] = dict(config, prompt_tokens_per_second=best_prompt_tps, tokens_per_second=best_gen_tps)
+        os.makedirs(os.path.dirname(ask.TUNING_PROFILES_PATH), exist_ok=True)
+        with open(ask.TUNING_PROFILES_PATH, "w") as f:
+            json.dump(profiles, f, indent=2)
+        print(f"Saved profile to {ask.TUNING_PROFILES_PATH}")